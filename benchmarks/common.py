@@ -0,0 +1,62 @@
+"""
+Timing and output helpers shared by the benchmarks, and the in-process peer
+pair for those that don't need a server.
+"""
+
+import sys
+import json
+import time
+import socket
+from contextlib import contextmanager
+from glass.bidirpc import BidirPC
+from glass.serdes import Serializer
+
+
+def best_of(fn, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def per_call(fn, n, repeat=5):
+    """
+    Best time for one of `n` back to back calls of `fn`.
+    """
+
+    def loop():
+        for _ in range(n):
+            fn()
+
+    fn()
+    return best_of(loop, repeat) / n
+
+
+def emit(result):
+    print(json.dumps(result), flush=True)
+
+
+def address(argv=None):
+    """
+    `host port` from the command line, a local server on 8000 by default.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    return (argv[0] if argv else "localhost"), (int(argv[1]) if len(argv) > 1 else 8000)
+
+
+@contextmanager
+def peers(**options):
+    """
+    Two serializers talking over a socketpair in this process, (sender, receiver).
+    """
+    a, b = socket.socketpair()
+    rpcs = [BidirPC().connect(a).start(), BidirPC().connect(b).start()]
+    try:
+        yield tuple(Serializer(rpc, **options) for rpc in rpcs)
+    finally:
+        for rpc, conn in zip(rpcs, (a, b)):
+            rpc.close()
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
@@ -0,0 +1,50 @@
+"""
+Encode cost of a large simple value, from `Serializer.serialize` to frame bytes.
+
+The baseline reproduces the old path: probe with `msgpack.packb`, throw the bytes
+away, then pack again for the frame.
+"""
+
+import json
+import msgpack
+from glass.serdes import Serializer
+from glass.bidirpc import BidirPC, ReqType, pack_default
+from benchmarks.common import best_of
+
+
+def probe_then_pack(value):
+    msgpack.packb(value)
+    return msgpack.packb((ReqType.RET.value, 1, [0, value]))
+
+
+def single_pass(ser, value):
+    # large containers go next to the frame, as they would on a socket
+    frame = (ReqType.RET.value, 1, ser.serialize(value))
+    return msgpack.packb(frame, default=lambda obj: pack_default(obj, []))
+
+
+def main():
+    ser = Serializer(BidirPC())
+    payloads = {
+        "list_int_1m": list(range(1_000_000)),
+        "dict_str_100k": {f"key{i}": f"value{i}" for i in range(100_000)},
+        "records_100k": [{"id": i, "name": f"n{i}", "score": i * 0.5} for i in range(100_000)],
+    }
+    for name, value in payloads.items():
+        raw = best_of(lambda: msgpack.packb(value))
+        before = best_of(lambda: probe_then_pack(value))
+        after = best_of(lambda: single_pass(ser, value))
+        print(
+            json.dumps(
+                {
+                    "bench": f"encode/{name}",
+                    "packb_s": raw,
+                    "probe_then_pack_x": before / raw,
+                    "single_pass_x": after / raw,
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Round trips against a running server (`python -m glass.server localhost 8000`):
+empty calls, remote object methods, generators, map, large payloads, and the
+calls a captured function makes back to the client.
+
+    python -m benchmarks.rpc [host] [port]
+"""
+
+import math
+from glass.client import Remote
+from benchmarks.common import address, best_of, emit, per_call
+
+SCALE = 3
+OFFSETS = [1, 2, 3]
+
+
+def noop():
+    return None
+
+
+def echo(value):
+    return value
+
+
+def square(x):
+    return x * x
+
+
+def count_up(n):
+    yield from range(n)
+
+
+def shift(x):
+    return x + sum(OFFSETS)
+
+
+def uses_globals(x):
+    # module constants, a module, and a helper: all globals of the client's
+    return math.floor(shift(x) * SCALE)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def incr(self):
+        self.value += 1
+        return self.value
+
+
+def calls(remote):
+    f = remote.capture(noop)
+    emit({"bench": "rpc/empty_call", "call_us": per_call(f, 2000) * 1e6})
+
+    counter = remote.capture(Counter)()
+    emit(
+        {
+            "bench": "rpc/netobj",
+            "method_call_us": per_call(counter.incr, 2000) * 1e6,
+            "getattr_us": per_call(lambda: counter.value, 2000) * 1e6,
+        }
+    )
+
+    gen = remote.capture(count_up)
+    n = 200_000
+    t = best_of(lambda: sum(gen(n)), repeat=3)
+    emit({"bench": "rpc/generator", "items_per_s": n / t})
+
+    t = best_of(lambda: sum(remote.map(square, range(n))), repeat=3)
+    emit({"bench": "rpc/map", "items_per_s": n / t})
+
+
+def payloads(remote):
+    f = remote.capture(echo)
+    blob = bytes(64 << 20)
+    t = best_of(lambda: f(blob))
+    records = [{"id": i, "name": f"n{i}", "score": i * 0.5} for i in range(100_000)]
+    t_records = best_of(lambda: f(records), repeat=3)
+    emit(
+        {
+            "bench": "rpc/payload",
+            "transport": remote.conn.family.name,
+            "bytes_mb_per_s": 2 * len(blob) / 1e6 / t,
+            "records_per_s": len(records) / t_records,
+        }
+    )
+
+
+def reverse_fetches(host, port, eager):
+    """
+    Calls the server makes back to the client for a function's globals, on the
+    first call and on later ones.
+    """
+    with Remote(host, port, metrics=True) as remote:
+        remote.ser.eager_globals = eager
+        f = remote.capture(uses_globals)
+        f(1)
+        first = remote.metrics()["nested"]["obj_call"]
+        f(2)
+        both = remote.metrics()["nested"]["obj_call"]
+    emit(
+        {
+            "bench": f"rpc/reverse_fetches/{'eager' if eager else 'lazy'}",
+            "first_call_nested": first["nested"],
+            "first_call_get_global": first["by_endpoint"].get("get_global_endpoint", 0),
+            "later_call_nested": both["nested"] - first["nested"],
+        }
+    )
+
+
+def main(host="localhost", port=8000):
+    with Remote(host, port) as remote:
+        calls(remote)
+        payloads(remote)
+    for eager in (True, False):
+        reverse_fetches(host, port, eager)
+
+
+if __name__ == "__main__":
+    main(*address())
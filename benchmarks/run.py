@@ -0,0 +1,158 @@
+"""
+The whole benchmark suite, each benchmark in a fresh interpreter, against a
+server started for the run unless `--server` names one:
+
+    python -m benchmarks.run --out results.json
+    python -m benchmarks.run --compare results.json
+
+Results are written as one JSON document with the machine and commit they were
+taken on. With `--compare`, metrics that got worse than the baseline by more
+than `--tolerance` are listed and the exit status is 1. Metrics ending in
+`_per_s` are better higher, all others better lower.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import subprocess
+from contextlib import contextmanager, nullcontext
+
+# module -> whether it needs a server
+SUITE = {
+    "encode": False,
+    "serdes": False,
+    "rpc": True,
+    "transport": True,
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def server(address):
+    if address is not None:
+        host, _, port = address.rpartition(":")
+        yield host, int(port)
+        return
+
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "glass.server", "localhost", str(port), "--log-level", "WARNING"]
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("localhost", port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or proc.poll() is not None:
+                    raise RuntimeError("benchmark server did not start")
+                time.sleep(0.05)
+        yield "localhost", port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def run(name, address):
+    """
+    Run one benchmark module, its JSON lines as dicts.
+    """
+    args = [sys.executable, "-m", f"benchmarks.{name}", *map(str, address or ())]
+    out = subprocess.run(args, stdout=subprocess.PIPE, text=True, check=True).stdout
+    return [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def meta():
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def compare(baseline, results, tolerance):
+    """
+    (bench, metric, before, after) for every metric that got worse by more than
+    `tolerance`, as a fraction.
+    """
+    before = {r["bench"]: r for r in baseline["results"]}
+    worse = []
+    for result in results:
+        old = before.get(result["bench"])
+        if old is None:
+            continue
+        for metric, value in result.items():
+            base = old.get(metric)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if not isinstance(base, (int, float)) or base == 0:
+                continue
+            change = (value - base) / abs(base)
+            if higher_is_better(metric):
+                change = -change
+            if change > tolerance:
+                worse.append((result["bench"], metric, base, value))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--server", help="host:port of a running server, one is started otherwise")
+    parser.add_argument("--only", action="append", choices=list(SUITE), help="repeatable")
+    parser.add_argument("--out", help="write the results here")
+    parser.add_argument("--compare", help="results of an earlier run to check against")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    names = args.only or list(SUITE)
+    results = []
+    needs_server = any(SUITE[name] for name in names)
+    with server(args.server) if needs_server else nullcontext() as address:
+        for name in names:
+            for result in run(name, address if SUITE[name] else None):
+                print(json.dumps(result), flush=True)
+                results.append(result)
+
+    document = {"meta": meta(), "results": results}
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(document, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        worse = compare(baseline, results, args.tolerance)
+        for bench, metric, base, value in worse:
+            print(f"regression: {bench} {metric} {base:.4g} -> {value:.4g}", file=sys.stderr)
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+`Serializer.serialize` and `deserialize` cost for code and containers, between
+two serializers in this process: `python -m benchmarks.serdes`.
+"""
+
+import math
+import dataclasses
+from glass.serdes import Serializer
+from benchmarks.common import best_of, emit, peers
+
+RATE = 0.07
+
+
+def score(values, weight=1.0):
+    total = 0.0
+    for v in values:
+        total += math.log1p(abs(v)) * weight * RATE
+    return total
+
+
+class Portfolio:
+    currency = "EUR"
+
+    def __init__(self, positions):
+        self.positions = positions
+
+    def value(self):
+        return sum(p.quantity * p.price for p in self.positions)
+
+    def weights(self):
+        total = self.value()
+        return [p.quantity * p.price / total for p in self.positions]
+
+
+@dataclasses.dataclass
+class Position:
+    ticker: str
+    quantity: int
+    price: float
+
+
+def main():
+    with peers() as (sender, receiver):
+        # the first send of a function or class ships it, later ones only its digest
+        for name, obj in {"function": score, "class": Portfolio}.items():
+            cold = best_of(lambda: Serializer(sender.rpc).serialize(obj), repeat=20)
+            payload = Serializer(sender.rpc).serialize(obj)
+            rebuild = best_of(lambda: Serializer(receiver.rpc).deserialize(payload), repeat=20)
+            sender.serialize(obj)
+            cached = best_of(lambda: sender.serialize(obj), repeat=200)
+            emit(
+                {
+                    "bench": f"serdes/{name}",
+                    "serialize_cold_us": cold * 1e6,
+                    "serialize_cached_us": cached * 1e6,
+                    "deserialize_cold_us": rebuild * 1e6,
+                }
+            )
+
+        values = {
+            "list_int_1m": list(range(1_000_000)),
+            "dict_str_100k": {f"key{i}": f"value{i}" for i in range(100_000)},
+            "records_100k": [{"id": i, "name": f"n{i}", "score": i * 0.5} for i in range(100_000)],
+            "dataclasses_10k": [Position(f"T{i}", i, i * 1.5) for i in range(10_000)],
+        }
+        for name, value in values.items():
+            ser = sender.serialize(value)
+            emit(
+                {
+                    "bench": f"serdes/{name}",
+                    "serialize_ms": best_of(lambda: sender.serialize(value)) * 1e3,
+                    "deserialize_ms": best_of(lambda: receiver.deserialize(ser)) * 1e3,
+                }
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Same-host transports against a running server (`python -m glass.server localhost 8000`):
+TCP loopback, the Unix socket, and the Unix socket with shared memory buffers.
+"""
+
+import sys
+import json
+import numpy as np
+from glass.client import Remote
+from benchmarks.common import best_of
+
+
+def echo(value):
+    return value
+
+
+def main(host="localhost", port=8000):
+    payload = np.random.rand(25_000_000)  # 200 MB
+    modes = {
+        "tcp": dict(local=False),
+        "unix": dict(local=True, shm=False),
+        "shm": dict(local=True, shm=True),
+    }
+    for mode, kwargs in modes.items():
+        with Remote(host, port, **kwargs) as remote:
+            remote_echo = remote.capture(echo)
+            rtt = best_of(lambda: remote_echo(1), repeat=200)
+            big = best_of(lambda: remote_echo(payload))
+            print(
+                json.dumps(
+                    {
+                        "bench": f"transport/{mode}",
+                        "transport": remote.conn.family.name,
+                        "empty_call_us": rtt * 1e6,
+                        "echo_200mb_s": big,
+                        "echo_mb_per_s": 2 * payload.nbytes / 1e6 / big,
+                    }
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2], *map(int, sys.argv[2:3]))
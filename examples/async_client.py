@@ -0,0 +1,47 @@
+import os
+import asyncio
+from glass.aio import AsyncRemote
+
+remote = AsyncRemote("localhost", 8000)
+
+SCALE = 3
+
+
+@remote.capture
+def scaled(x):
+    # SCALE is fetched back from the client while the call runs
+    return x * SCALE
+
+
+@remote.capture
+def countdown(n):
+    while n > 0:
+        yield n
+        n -= 1
+
+
+@remote.capture
+class Counter:
+    def __init__(self):
+        self.values = {"cwd": os.getcwd()}
+
+    def add(self, k, v):
+        self.values[k] = v
+        return len(self.values)
+
+
+async def main():
+    async with remote:
+        results = await asyncio.gather(*(scaled(i) for i in range(5)))
+        print(f"Scaled: {results}")
+
+        print(f"Countdown: {[i async for i in await countdown(3)]}")
+
+        counter = await Counter()
+        print(f"Entries: {await counter.add('a', 1)}")
+        values = await counter.values
+        print(f"Remote cwd: {values['cwd']}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
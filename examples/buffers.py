@@ -0,0 +1,22 @@
+import time
+import numpy as np
+from glass.client import Remote
+
+remote = Remote("localhost", 8000)
+
+
+@remote.capture
+def normalize(features):
+    # arrives as a real ndarray, dtype and shape intact
+    return (features - features.mean(axis=0)) / features.std(axis=0)
+
+
+if __name__ == "__main__":
+    features = np.random.rand(1_000_000, 16).astype(np.float32)
+
+    start = time.time()
+    out = normalize(features)
+    elapsed = time.time() - start
+
+    print(f"Result: {out.dtype} {out.shape}")
+    print(f"Moved {2 * features.nbytes / 1e6:.0f} MB in {elapsed:.2f}s")
@@ -0,0 +1,23 @@
+import math
+from glass.client import Remote
+
+remote = Remote("localhost", 8000)
+
+
+def score(record):
+    return round(math.log1p(record["clicks"]) * record["weight"], 3)
+
+
+def records(n):
+    # consumed lazily, only a few chunks ahead of the results
+    for i in range(n):
+        yield {"clicks": i % 97, "weight": 1 + i % 5}
+
+
+# the function is shipped once, inputs go in chunks and results stream back
+scores = remote.map(score, records(100_000), chunksize=1000)
+print(f"Total score: {sum(scores):.1f}")
+
+# argument tuples, results in completion order
+sums = remote.starmap(pow, [(2, 10), (3, 5), (10, 3)], ordered=False)
+print(f"Powers: {sorted(sums)}")
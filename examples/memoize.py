@@ -0,0 +1,23 @@
+import time
+from glass.client import Remote
+
+remote = Remote("localhost", 8000)
+
+
+# pure: same arguments, same result, so the server may keep it for a minute
+@remote.capture(cache=60)
+def daily_totals(region, days):
+    totals = {}
+    for day in range(days):
+        totals[day] = sum((i * day) % 97 for i in range(20_000)) + len(region)
+    return totals
+
+
+if __name__ == "__main__":
+    for attempt in range(3):
+        start = time.perf_counter()
+        totals = daily_totals("emea", days=30)
+        print(f"Call {attempt}: {len(totals)} days in {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+    # shared by every connection to this server, until it restarts
+    print(f"Cache: {remote.memo_stats()}")
@@ -0,0 +1,46 @@
+import time
+from glass.client import Remote
+from glass.netobj import pipeline
+
+remote = Remote("localhost", 8000)
+
+
+@remote.capture
+class Series:
+    def __init__(self, values):
+        self.values = values
+
+    def mean(self):
+        return sum(self.values) / len(self.values)
+
+    def scaled(self, factor):
+        return Series([v * factor for v in self.values])
+
+
+@remote.capture
+class Processor:
+    def __init__(self):
+        self.stats = {"latency": Series([12.0, 15.0, 9.0])}
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1e3
+
+
+if __name__ == "__main__":
+    processor = Processor()
+
+    # a round trip for every remote step
+    mean, ms = timed(lambda: processor.stats["latency"].mean())
+    print(f"Stepwise: {mean} in {ms:.2f} ms")
+
+    # recorded locally, evaluated remotely in one round trip
+    mean, ms = timed(lambda: pipeline(processor).stats["latency"].mean().resolve())
+    print(f"Pipelined: {mean} in {ms:.2f} ms")
+
+    # a promise passed as an argument is evaluated where it lives
+    latency = pipeline(processor).stats["latency"]
+    scaled = latency.scaled(latency.mean())
+    print(f"Scaled by its own mean: {float(scaled.mean())}")
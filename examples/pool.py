@@ -0,0 +1,48 @@
+import os
+from glass.pool import RemotePool
+
+# start two servers first:
+#   python -m glass.server localhost 8000
+#   python -m glass.server localhost 8001
+pool = RemotePool([("localhost", 8000), ("localhost", 8001)], per_host=2)
+
+
+def simulate(seed):
+    import random
+
+    rng = random.Random(seed)
+    return sum(rng.random() for _ in range(100_000)) / 100_000, os.getpid()
+
+
+class Model:
+    def __init__(self):
+        self.seen = 0
+
+    def update(self, batch):
+        self.seen += len(batch)
+        return self.seen
+
+
+def new_model():
+    return Model()
+
+
+def train(model, batch):
+    return model.update(batch)
+
+
+if __name__ == "__main__":
+    # least loaded connection for every call
+    futures = [pool.submit(simulate, seed) for seed in range(8)]
+    results = [f.result() for f in futures]
+    mean = sum(m for m, _ in results) / len(results)
+    print(f"Mean: {mean:.3f} from {len({pid for _, pid in results})} processes")
+
+    # the model lives on one connection, calls that use it go there
+    model = pool.submit(new_model).result()
+    for batch in ([1, 2], [3, 4, 5]):
+        seen = pool.submit(train, model, batch).result()
+    print(f"Model saw {seen} items on connection {pool.owner(model)}")
+
+    print(f"Squares: {sum(pool.starmap(pow, ((i, 2) for i in range(1000)), chunksize=100))}")
+    pool.close()
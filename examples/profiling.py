@@ -0,0 +1,23 @@
+import math
+from glass.client import Remote
+
+remote = Remote("localhost", 8000)
+
+WEIGHTS = [math.sin(i) for i in range(1000)]
+
+
+@remote.capture
+def weighted(values):
+    return [v * WEIGHTS[i % len(WEIGHTS)] for i, v in enumerate(values)]
+
+
+if __name__ == "__main__":
+    values = list(range(200_000))
+    with remote.profile() as report:
+        for _ in range(3):
+            weighted(values)
+
+    # time spent (de)serializing, waiting on the peer and running, on each end
+    print(report)
+    slowest = max(report.calls, key=lambda call: call[1])
+    print(f"Slowest round trip: {slowest[0]} in {slowest[1] * 1e3:.1f} ms")
@@ -0,0 +1,26 @@
+import sys
+from glass.client import Remote
+
+# a token from an earlier run resumes its session, which the server keeps for a while
+token = sys.argv[1] if len(sys.argv) > 1 else True
+remote = Remote("localhost", 8000, session=token)
+print(f"Session {remote.token}, resumed: {remote.resumed}")
+
+
+class Tally:
+    def __init__(self):
+        self.seen = []
+
+    def add(self, item):
+        self.seen.append(item)
+        return len(self.seen)
+
+
+if __name__ == "__main__":
+    tally = remote.capture(Tally)()
+    tally.add("before")
+
+    # a dropped connection, the remote object survives it
+    remote.reconnect()
+    print(f"Items after reconnecting: {tally.add('after')}")
+    print(f"Resume from another process: python examples/sessions.py {remote.token}")
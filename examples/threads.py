@@ -0,0 +1,46 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glass.client import Remote
+
+remote = Remote("localhost", 8000)
+
+DELAY = 0.5
+
+
+# many threads share one connection, each call fetches DELAY back from the client
+@remote.capture
+def slow_double(x):
+    time.sleep(DELAY)
+    return x * 2
+
+
+@remote.capture
+def fails(x):
+    raise ValueError(f"bad input {x}")
+
+
+@remote.capture
+def exits():
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    start = time.time()
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(slow_double, range(8)))
+    print(f"Results: {results}")
+    print(f"8 calls of {DELAY}s took {time.time() - start:.2f}s on one connection")
+
+    try:
+        fails(3)
+    except ValueError as e:
+        print(f"Remote error: {e}")
+
+    try:
+        exits()
+    except RuntimeError as e:
+        print(f"Remote exit: {e}")
+
+    # the connection is still usable after errors
+    print(f"Still alive: {slow_double(21)}")
@@ -0,0 +1,50 @@
+import datetime
+from dataclasses import dataclass
+from glass.client import Remote
+from glass.serdes import byref
+
+remote = Remote("localhost", 8000)
+
+
+@dataclass
+class Point:
+    x: int
+    y: int
+
+
+class Handle:
+    """not a value type, stays on the client and is passed by reference"""
+
+    def __init__(self, name):
+        self.name = name
+
+
+@remote.capture
+def inspect_values(values):
+    return [type(v).__name__ for v in values]
+
+
+@remote.capture
+def echo(value):
+    return value
+
+
+@remote.capture
+def append_remote(lst, item):
+    lst.append(item)
+
+
+if __name__ == "__main__":
+    # copied in one round trip, only the Handle goes by reference
+    values = [datetime.date(2024, 1, 1), {1, 2, 3}, Point(1, 2), (Handle("h"), 3)]
+    print(f"Remote types: {inspect_values(values)}")
+
+    back = echo(values)
+    print(f"Round trip: {back[:3]}, handle is original: {back[3][0] is values[3][0]}")
+
+    # copies don't write back, byref keeps reference semantics
+    items = [Handle("a")]
+    append_remote(items, 1)
+    print(f"After copy: {len(items)} item(s)")
+    append_remote(byref(items), 2)
+    print(f"After byref: {len(items)} item(s)")
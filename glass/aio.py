@@ -0,0 +1,416 @@
+import sys
+import asyncio
+import inspect
+import logging
+import itertools
+from collections import deque
+import msgpack
+import pickle
+from .serdes import Serializer
+from .netobj import StaleMethod, stub_id
+from .types import ExtCode
+from .bidirpc import ExtHooks, ReqType, pack_default, pack_exception
+from .util import fmt_args_kwargs, pretty
+from . import local
+from . import compress
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBidirPC:
+    """
+    asyncio flavour of `BidirPC`, speaking the same protocol over asyncio streams.
+
+    Calls are coroutines resolved by a reader task. Incoming calls run as tasks on
+    the event loop, endpoints may be plain functions or coroutine functions. Plain
+    endpoints run on the loop, so they must not block on calls of their own.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.ext_hooks = ExtHooks()
+        self.ext_hooks[ExtCode.BUFFER.value] = self.incoming_buffer
+        self.unpacker = self.ext_hooks.unpacker()
+        self.incoming = None
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.tasks = set()
+        # failures of our one-way calls, raised by the next call
+        self.notify_errors = deque()
+        self.codec = None
+        self.compress_threshold = compress.COMPRESS_THRESHOLD
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.closed = False
+
+    def endpoint(self, func):
+        self.endpoints[func.__name__] = func
+        return func
+
+    def live(self):
+        return self.writer is not None and not self.closed
+
+    def connect(self, reader, writer):
+        assert self.writer is None
+        self.reader = reader
+        self.writer = writer
+        return self
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.spawn(self.serve())
+        return self
+
+    async def serve(self):
+        try:
+            while True:
+                resp = await self.reader.read(65536)
+                if not resp:
+                    break
+
+                self.unpacker.feed(resp)
+                for req in self.unpacker:
+                    req_type = ReqType(req[0])
+                    if req_type == ReqType.BUFFERS:
+                        self.incoming = [await self.recv_buffer(n) for n in req[1]]
+                        continue
+
+                    self.incoming = None
+                    if req_type == ReqType.CALL:
+                        self.spawn(self.handle(*req[1:5]))
+                    elif req_type == ReqType.RET:
+                        req_id, ret = req[1:]
+                        self.resolve(req_id, ret, None)
+                    elif req_type == ReqType.ERR:
+                        req_id, s = req[1:]
+                        self.resolve(req_id, None, pickle.loads(s))
+        except OSError:
+            pass
+        finally:
+            logger.debug("reader: connection closed")
+            self.close()
+
+    async def recv_buffer(self, n):
+        head = self.unpacker.read_bytes(n)
+        if len(head) == n:
+            return bytearray(head)
+        return bytearray(head) + await self.reader.readexactly(n - len(head))
+
+    def incoming_buffer(self, data):
+        return self.incoming[msgpack.unpackb(data)]
+
+    def resolve(self, req_id, value, error):
+        if req_id is None:
+            logger.warning(f"one-way call failed: {error!r}")
+            self.notify_errors.append(error)
+            return
+        fut = self.pending.pop(req_id, None)
+        if fut is None or fut.done():
+            logger.debug(f"dropping reply for unknown request {req_id}")
+        elif error is not None:
+            if isinstance(error, StopIteration):
+                # futures refuse StopIteration, iteration itself ends in-band
+                error = RuntimeError("remote call raised StopIteration")
+            fut.set_exception(error)
+        else:
+            fut.set_result(value)
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        # the loop only keeps weak references to tasks
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def submit(self, fn, *args):
+        """
+        Schedule `fn(*args)` on the loop from any thread, for calls made from __del__.
+        """
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        async def run():
+            try:
+                ret = fn(*args)
+                if inspect.isawaitable(ret):
+                    await ret
+            except Exception:
+                logger.debug(f"{fn.__name__}{args} failed", exc_info=True)
+
+        try:
+            self.loop.call_soon_threadsafe(self.spawn, run())
+        except RuntimeError:
+            logger.debug(f"dropping {fn.__name__}{args}: event loop closed")
+
+    async def handle(self, req_id, cmd, args, kwargs):
+        try:
+            resp = self.endpoints[cmd](*args, **kwargs)
+            if inspect.isawaitable(resp):
+                resp = await resp
+            if req_id is not None:
+                self.send((ReqType.RET.value, req_id, resp))
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            try:
+                self.send((ReqType.ERR.value, req_id, pack_exception(e)))
+            except Exception:
+                logger.exception(f"could not send error for request {req_id}")
+
+    def send(self, packet):
+        # no sendmsg on a stream, buffers go inline
+        packet = msgpack.packb(packet, default=lambda obj: pack_default(obj, None))
+        if self.codec is not None:
+            packet = compress.compress(self.codec, packet, self.compress_threshold)
+        self.writer.write(packet)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for fut in self.pending.values():
+            if not fut.done():
+                fut.set_exception(EOFError("connection closed"))
+        self.pending.clear()
+        if self.writer is not None:
+            self.writer.close()
+
+    def notify(self, name, *args, **kwargs):
+        """
+        Call endpoint `name` without waiting, a failure is raised by the next call.
+        """
+        if self.closed:
+            raise EOFError("connection closed")
+        self.send((ReqType.CALL.value, None, name, args, kwargs))
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            if self.closed:
+                raise EOFError("connection closed")
+            if self.notify_errors:
+                raise self.notify_errors.popleft()
+
+            req_id = next(self.ids)
+            fut = self.pending[req_id] = self.loop.create_future()
+            self.send((ReqType.CALL.value, req_id, name, args, kwargs))
+            try:
+                await self.writer.drain()
+                resp = await fut
+            except asyncio.CancelledError:
+                # a timeout or a cancelled task: the server can stop too
+                if self.pending.pop(req_id, None) is not None and self.live():
+                    self.send((ReqType.CANCEL.value, req_id))
+                raise
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{name} -> ({fmt_args_kwargs(args, kwargs)}) -> {pretty(resp)}")
+            return resp
+
+        return call
+
+
+class AsyncAttr:
+    """
+    A pending attribute of an `AsyncNetworkObj`, `await obj.attr` fetches it and
+    `await obj.method(...)` fetches and calls it.
+    """
+
+    def __init__(self, obj, name):
+        self.obj = obj
+        self.name = name
+
+    async def get(self):
+        ser = self.obj._AsyncNetworkObj__glass_ser
+        obj_id = self.obj._AsyncNetworkObj__glass_obj_id
+        resp = await ser.rpc.obj_getattr(obj_id, self.name)
+        return ser.deserialize(resp)
+
+    def __await__(self):
+        return self.get().__await__()
+
+    async def __call__(self, *args, **kwargs):
+        # most calls are of methods defined on the class, try that in one round trip
+        ser = self.obj._AsyncNetworkObj__glass_ser
+        obj_id = self.obj._AsyncNetworkObj__glass_obj_id
+        args_ser = tuple(ser.serialize(arg) for arg in args)
+        kwargs_ser = {k: ser.serialize(v) for k, v in kwargs.items()}
+        try:
+            resp = await ser.rpc.obj_call_method(obj_id, self.name, args_ser, kwargs_ser)
+        except StaleMethod:
+            attr = await self.get()
+            return await attr(*args, **kwargs)
+        return ser.deserialize(resp)
+
+
+class AsyncNetworkObj:
+    """
+    `NetworkObj` whose operations are awaitable, returned by `AsyncRemote`.
+    """
+
+    def __init__(self, ser, obj_id, cls_id=None):
+        self.__glass_ser = ser
+        self.__glass_obj_id = obj_id
+
+    def __getattr__(self, name):
+        if name.startswith("_AsyncNetworkObj__glass_"):
+            raise AttributeError(name)
+        return AsyncAttr(self, name)
+
+    async def __call__(self, *args, **kwargs):
+        args = tuple(self.__glass_ser.serialize(arg) for arg in args)
+        kwargs = {k: self.__glass_ser.serialize(v) for k, v in kwargs.items()}
+
+        ser = await self.__glass_ser.rpc.obj_call(self.__glass_obj_id, args, kwargs)
+        return self.__glass_ser.deserialize(ser)
+
+    async def __getitem__(self, item):
+        item = self.__glass_ser.serialize(item)
+        ser = await self.__glass_ser.rpc.obj_getitem(self.__glass_obj_id, item)
+        return self.__glass_ser.deserialize(ser)
+
+    def __aiter__(self):
+        return AsyncRemoteIter(self)
+
+    def __del__(self):
+        if sys.is_finalizing():
+            return
+
+        rpc = self.__glass_ser.rpc
+        if not rpc.live():
+            return
+
+        self.__glass_ser.release_stub(self.__glass_obj_id)
+
+
+class AsyncRemoteIter:
+    """
+    `async for` over a remote iterable, iter() is taken lazily on the first item.
+    Items come in batches that double up to the serializer's `prefetch`.
+    """
+
+    def __init__(self, obj):
+        # holding the stub keeps the remote object alive while iterating
+        self.obj = obj
+        self.ser = obj._AsyncNetworkObj__glass_ser
+        self.obj_id = obj._AsyncNetworkObj__glass_obj_id
+        self.it = None
+        self.size = 1
+        self.buffer = deque()
+        self.done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.it is None:
+            self.it = self.ser.deserialize(await self.ser.rpc.obj_iter(self.obj_id))
+
+        while not self.buffer:
+            if self.done:
+                raise StopAsyncIteration
+            it_id = stub_id(self.it)
+            items, self.done = await self.ser.rpc.obj_next_batch(it_id, self.size)
+            self.size = min(self.size * 2, self.ser.prefetch)
+            self.buffer.extend(items)
+
+        return self.ser.deserialize(self.buffer.popleft())
+
+
+class AsyncCaptured:
+    """
+    Captured function or class of an `AsyncRemote`. Decorators can't await, so the
+    object is shipped to the server on the first call.
+    """
+
+    def __init__(self, remote, obj, cache=False):
+        self.remote = remote
+        self.obj = obj
+        self.cache = cache
+        self.stub = None
+        self.__name__ = getattr(obj, "__name__", None)
+        self.__qualname__ = getattr(obj, "__qualname__", None)
+        self.__module__ = getattr(obj, "__module__", None)
+
+    async def add(self):
+        ser = self.remote.ser.serialize(self.obj)
+        if self.cache:
+            ttl = None if self.cache is True else float(self.cache)
+            stub = await self.remote.rpc.add_obj(ser, to_global=True, cache=True, ttl=ttl)
+        else:
+            stub = await self.remote.rpc.add_obj(ser, to_global=True)
+        return self.remote.ser.deserialize(stub)
+
+    async def __call__(self, *args, **kwargs):
+        if self.stub is None:
+            self.stub = asyncio.ensure_future(self.add())
+        stub = await self.stub
+        return await stub(*args, **kwargs)
+
+
+class AsyncRemote:
+    """
+    asyncio flavour of `Remote`:
+
+        async with AsyncRemote("localhost", 8000) as remote:
+            ...
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        local=None,
+        compression=None,
+        compress_threshold=compress.COMPRESS_THRESHOLD,
+    ):
+        self.host = host
+        self.port = port
+        self.local = local
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.rpc = None
+        self.ser = None
+
+    async def connect(self):
+        reader, writer = await self.open_connection()
+        self.rpc = AsyncBidirPC()
+        self.rpc.connect(reader, writer).start()
+        if self.compression:
+            names = compress.offer(self.compression)
+            name = await self.rpc.enable_compression_endpoint(names, self.compress_threshold)
+            if name is not None:
+                self.rpc.codec = compress.CODECS[name]
+                self.rpc.compress_threshold = self.compress_threshold
+        self.ser = Serializer(self.rpc, netobj=AsyncNetworkObj)
+        return self
+
+    async def open_connection(self):
+        # same host: the server's Unix socket, buffers still travel inline
+        use_local = self.local
+        if use_local is None:
+            use_local = await asyncio.to_thread(local.is_local, self.host)
+        if use_local:
+            try:
+                return await asyncio.open_unix_connection(local.socket_path(self.port))
+            except OSError as e:
+                logger.debug(f"no local socket for port {self.port} ({e}), using TCP")
+        return await asyncio.open_connection(self.host, self.port)
+
+    async def close(self):
+        self.rpc.close()
+        await self.rpc.writer.wait_closed()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def capture(self, obj=None, cache=False):
+        if obj is None:
+            return lambda obj: self.capture(obj, cache)
+        # raise exception if obj is a method in a class
+        if hasattr(obj, "__qualname__") and "." in obj.__qualname__:
+            raise Exception("cannot capture bound method")
+
+        return AsyncCaptured(self, obj, cache)
@@ -1,10 +1,24 @@
+import os
+import time
+import heapq
+import ctypes
 import socket
 import logging
+import itertools
+from collections import deque
+from contextlib import contextmanager
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from enum import Enum
 import msgpack
 import pickle
 from tblib import pickling_support
+from .types import ExtCode
 from .util import fmt_args_kwargs, pretty
+from . import local
+from . import compress
+from .metrics import Metrics
+from . import profiling
 import json
 
 
@@ -25,6 +39,25 @@ class ReqType(Enum):
     CALL = 0
     RET = 1
     ERR = 2
+    # sizes of the raw buffers that follow, used by the next frame's BUFFER exts
+    BUFFERS = 3
+    # same, but the buffers are in a shared memory segment passed with the header
+    SHM_BUFFERS = 4
+    # raw bytes of a large frame, sent in pieces, see BidirPC.send_chunked()
+    CHUNK = 5
+    # the caller gave up on a call, see BidirPC.cancel()
+    CANCEL = 6
+
+
+# buffers at least this big travel after the frame instead of inside it
+OOB_THRESHOLD = 1 << 16
+# sendmsg() iovec limit
+IOV_MAX = 1024
+# receive buffer, grown while reads keep filling it
+RECV_MIN = 1 << 16
+RECV_MAX = 1 << 22
+# frames larger than this are split into chunks once the peer agreed to
+CHUNK_SIZE = 1 << 18
 
 
 def can_serialize(obj):
@@ -35,16 +68,391 @@ def can_serialize(obj):
         return False
 
 
+def pack_exception(exc):
+    """
+    Pickle an exception for an ERR frame, degrading to a plain Exception when it
+    can't be pickled or must not propagate (SystemExit and friends).
+    """
+    if not isinstance(exc, Exception):
+        exc = RuntimeError(f"remote call raised {type(exc).__name__}: {exc}")
+    try:
+        return pickle.dumps(exc)
+    except Exception:
+        return pickle.dumps(Exception(f"{type(exc).__name__}: {exc}"))
+
+
+class Cancelled(BaseException):
+    """
+    Raised inside an endpoint whose call was cancelled or ran past its
+    deadline. A BaseException, so `except Exception` in user code lets it by.
+    """
+
+
+def interrupt(ident, exc=Cancelled):
+    """
+    Raise `exc` in thread `ident` at its next bytecode, or with None take back
+    one that hasn't gone off yet. Code blocked in C, such as a sleep or a read,
+    only sees it once that returns.
+    """
+    exc = None if exc is None else ctypes.py_object(exc)
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), exc)
+
+
+def unpack_packed(data):
+    return msgpack.unpackb(data, strict_map_key=False)
+
+
+class OutOfBand:
+    """
+    A buffer for the wire. Large ones are sent raw next to the frame, from the
+    caller's memory, and received straight into a preallocated bytearray.
+    """
+
+    __slots__ = ("view",)
+
+    def __init__(self, view):
+        self.view = view
+
+
+def pack_default(obj, buffers):
+    if type(obj) is OutOfBand:
+        if obj.view.nbytes < OOB_THRESHOLD or buffers is None:
+            return obj.view
+        buffers.append(obj.view)
+        return msgpack.ExtType(ExtCode.BUFFER.value, msgpack.packb(len(buffers) - 1))
+    raise TypeError(f"can not serialize {type(obj).__name__!r} object")
+
+
+def sendmsg_all(conn, buffers, ancdata=()):
+    """
+    sendall() for a list of buffers, without joining them. `ancdata` goes with
+    the first byte.
+    """
+    views = deque(memoryview(b).cast("B") for b in buffers)
+    while views:
+        sent = conn.sendmsg(list(itertools.islice(views, IOV_MAX)), ancdata)
+        ancdata = ()
+        while sent:
+            if sent >= views[0].nbytes:
+                sent -= views.popleft().nbytes
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+        while views and not views[0].nbytes:
+            views.popleft()
+
+
+class ExtHooks(dict):
+    """
+    msgpack ext code -> decoder, run by the reader as frames are unpacked.
+    """
+
+    def __init__(self):
+        super().__init__(
+            {
+                ExtCode.PACKED.value: unpack_packed,
+                ExtCode.COMPRESSED.value: self.unpack_compressed,
+            }
+        )
+
+    def __call__(self, code, data):
+        hook = self.get(code)
+        if hook is None:
+            return msgpack.ExtType(code, data)
+        return hook(data)
+
+    def unpacker(self):
+        return msgpack.Unpacker(ext_hook=self, strict_map_key=False)
+
+    def unpack_compressed(self, data):
+        return msgpack.unpackb(compress.decompress(data), ext_hook=self, strict_map_key=False)
+
+
+class Pending:
+    """
+    A call that has been sent and is waiting for its RET or ERR.
+    """
+
+    __slots__ = (
+        "event",
+        "value",
+        "error",
+        "on_done",
+        "name",
+        "started",
+        "root",
+        "profile",
+        "req_id",
+        "deadline",
+        "cancelled",
+    )
+
+    def __init__(self, on_done=None):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        # called with the slot once it's done, on the reader thread, must not block
+        self.on_done = on_done
+        self.name = None
+        # with metrics: when it was sent, and its root if it's top-level
+        self.started = None
+        self.root = None
+        # (report, endpoint, sent at) for a call wrapped in profile_endpoint
+        self.profile = None
+        self.req_id = None
+        # time.monotonic() by which the caller stops waiting
+        self.deadline = None
+        # the caller gave up, the reply is dropped
+        self.cancelled = False
+
+    def resolve(self, value):
+        self.value = value
+        self.done()
+
+    def fail(self, error):
+        self.error = error
+        self.done()
+
+    def done(self):
+        self.event.set()
+        if self.on_done is not None:
+            self.on_done(self)
+
+
+class Running:
+    """
+    A call received from the peer, from when it's queued until it's answered.
+    """
+
+    __slots__ = ("cmd", "deadline", "thread", "cancelled")
+
+    def __init__(self, cmd, deadline):
+        self.cmd = cmd
+        self.deadline = deadline
+        # ident of the worker running it, while it runs
+        self.thread = None
+        # why it was cancelled, if it was
+        self.cancelled = None
+
+    def error(self):
+        if self.cancelled == "deadline":
+            return TimeoutError(f"{self.cmd} ran past its deadline")
+        return CancelledError(f"{self.cmd} was cancelled")
+
+
+class Deadlines:
+    """
+    Calls `expire(req_id)` for calls still around at their deadline, from one
+    background thread. Finished calls are `discard`ed, their heap entries are
+    dropped once they make up most of the heap.
+    """
+
+    def __init__(self, expire):
+        self.expire = expire
+        self.heap = []
+        # req_id -> deadline, for the calls not finished yet
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def add(self, deadline, req_id):
+        with self.cond:
+            self.pending[req_id] = deadline
+            heapq.heappush(self.heap, (deadline, req_id))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, name="glass-deadlines", daemon=True
+                )
+                self.thread.start()
+            elif self.heap[0][1] == req_id:
+                self.cond.notify()
+
+    def run(self):
+        with self.cond:
+            while not self.closed:
+                if not self.heap:
+                    self.cond.wait()
+                    continue
+                deadline, req_id = self.heap[0]
+                left = deadline - time.monotonic()
+                if left > 0:
+                    self.cond.wait(left)
+                    continue
+                heapq.heappop(self.heap)
+                if self.pending.get(req_id) == deadline:
+                    del self.pending[req_id]
+                    self.expire(req_id)
+
+    def discard(self, req_id):
+        with self.cond:
+            if self.pending.pop(req_id, None) is None:
+                return
+            if len(self.heap) > 2 * len(self.pending) + 64:
+                self.heap = [e for e in self.heap if self.pending.get(e[1]) == e[0]]
+                heapq.heapify(self.heap)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.heap.clear()
+            self.pending.clear()
+            self.cond.notify()
+
+
+class Incoming:
+    """
+    A frame arriving in chunks: its buffers and then the frame itself, each
+    filled in place as the chunks come in.
+    """
+
+    __slots__ = ("parts", "index", "pos")
+
+    def __init__(self, sizes):
+        self.parts = [bytearray(n) for n in sizes]
+        self.index = 0
+        self.pos = 0
+
+    def take(self, n):
+        """
+        Views on the next `n` bytes of the parts, in order.
+        """
+        while n:
+            part = self.parts[self.index]
+            k = min(n, len(part) - self.pos)
+            yield memoryview(part)[self.pos : self.pos + k]
+            n -= k
+            self.pos += k
+            if self.pos == len(part):
+                self.index += 1
+                self.pos = 0
+
+    def complete(self):
+        return self.index == len(self.parts)
+
+
 class BidirPC:
     """
     Bidirectional RPC handler, based on a socket connection.
     The socket connection can be either the client or server side.
+
+    Every CALL carries a request id that is echoed back in its RET or ERR, so
+    any number of threads can have calls in flight on one connection. A single
+    reader thread routes replies to their waiters and runs incoming calls on a
+    bounded pool of worker threads, which keeps reentrant callbacks working.
+    The reader itself never blocks on a call.
+
+    Endpoints may run concurrently, so any state they share must be safe to
+    touch from several threads (see `Serializer.obj_lock`). A chain of nested
+    callbacks holds one worker per level, `max_workers` bounds its depth.
+
+    `notify` makes one-way calls, CALL frames without a request id that get no
+    reply unless they fail. The receiver runs them one at a time in the order
+    they arrived, and any call that arrives later waits for them, so a call
+    sees the effect of every notification sent before it.
+
+    `enable_metrics` starts collecting call latencies, frame sizes and nested
+    call counts for this end of the connection, see `glass.metrics`.
+
+    A call can have a deadline, from `timeout`, `deadline()` or the call being
+    handled on the same thread. It travels in the CALL frame as the seconds
+    left, and calls the handler makes inherit what remains of it. The caller
+    stops waiting at the deadline, or on Ctrl-C, and sends a CANCEL: the peer
+    interrupts the endpoint if it's still running, and skips it if it hasn't
+    started. A reply that crossed the CANCEL is handed to `on_dropped` instead
+    of the caller, so whatever it references can be released.
+
+    Once `enable_chunking` is agreed, frames larger than `chunk_size` go out as
+    CHUNK frames that take turns on the socket with everything else, so a large
+    result doesn't hold up the small calls behind it. The peer reassembles
+    them straight into the frame's buffers and dispatches the frame once its
+    last chunk is in.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=32):
         self.endpoints = {}
-        self.unpacker = msgpack.Unpacker()
-        self.queue = []
+        self.ext_hooks = ExtHooks()
+        self.unpacker = self.ext_hooks.unpacker()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.send_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="glass-worker")
+        # one-way calls, in order
+        self.lane = ThreadPoolExecutor(1, thread_name_prefix="glass-notify")
+        self.last_notify = None
+        # failures of our one-way calls, raised by the next call
+        self.notify_errors = deque()
+        self.ext_hooks[ExtCode.BUFFER.value] = self.incoming_buffer
+        self.recv_buf = bytearray(RECV_MIN)
+        # frames waiting for whichever thread takes the send lock next
+        self.outbox = deque()
+        # the next chunk of each large frame being sent, written after the outbox
+        self.chunk_outbox = deque()
+        self.stream_ids = itertools.count(1)
+        # stream id -> Incoming, large frames being received
+        self.streams = {}
+        # split larger frames into chunks once the peer agreed to
+        self.chunk_size = None
+        self.dispatch = {
+            ReqType.CALL.value: self.on_call,
+            ReqType.RET.value: self.on_ret,
+            ReqType.ERR.value: self.on_err,
+            ReqType.BUFFERS.value: self.on_buffers,
+            ReqType.SHM_BUFFERS.value: self.on_shm_buffers,
+            ReqType.CHUNK.value: self.on_chunk,
+            ReqType.CANCEL.value: self.on_cancel,
+        }
+        # raw buffers announced by the last BUFFERS header
+        self.incoming = None
+        # send large buffers through shared memory, once the peer agreed to
+        self.shm = False
+        # descriptors received ahead of their SHM_BUFFERS header
+        self.fds = deque()
+        # compress large frames once a codec is negotiated, see glass.compress
+        self.codec = None
+        self.compress_threshold = compress.COMPRESS_THRESHOLD
+        self.metrics = None
+        # root token and deadline of the call being handled on this thread, for calls it makes
+        self.context = threading.local()
+        # default time limit for our calls, in seconds
+        self.timeout = None
+        # req_id -> Running, calls from the peer not yet answered
+        self.running = {}
+        self.running_lock = threading.Lock()
+        self.deadlines = Deadlines(lambda req_id: self.cancel_running(req_id, "deadline"))
+        # taken to hand a pending call either to its reply or to cancel()
+        self.cancel_lock = threading.Lock()
+        # on_dropped(name, value) gets replies to calls we gave up on, on a worker
+        self.on_dropped = None
+
+        @self.endpoint
+        def enable_shm_endpoint():
+            self.shm = local.can_share(self.conn)
+            return self.shm
+
+        @self.endpoint
+        def enable_compression_endpoint(names, threshold):
+            self.codec = compress.choose(names)
+            self.compress_threshold = threshold
+            return self.codec and self.codec.name
+
+        @self.endpoint
+        def enable_chunking_endpoint(size):
+            self.chunk_size = size
+
+        @self.endpoint
+        def enable_metrics_endpoint():
+            self.enable_metrics()
+
+        @self.endpoint
+        def metrics_endpoint():
+            return None if self.metrics is None else self.metrics.snapshot()
+
+        @self.endpoint
+        def profile_endpoint(cmd, args, kwargs):
+            return profiling.run(self.endpoints[cmd], args, kwargs)
+        self.reader = None
+        self.closed = False
         self.conn = None
 
     def endpoint(self, func):
@@ -52,59 +460,519 @@ class BidirPC:
         return func
 
     def live(self):
-        if self.conn:
+        if self.conn and not self.closed:
             return self.conn.fileno() != -1
         return False
 
     def connect(self, conn):
         assert self.conn is None
         assert isinstance(conn, socket.socket)
+        if conn.family in (socket.AF_INET, socket.AF_INET6):
+            # frames are written whole, Nagle would only hold small calls back
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.conn = conn
         return self
 
-    def recv(self):
-        while len(self.queue) == 0:
-            resp = self.conn.recv(1024)
-            if not resp:
+    def enable_shm(self):
+        """
+        Ask the peer to take large buffers through shared memory and do the
+        same, if both ends are on a Unix socket.
+        """
+        if local.can_share(self.conn):
+            self.shm = self.enable_shm_endpoint()
+        return self.shm
+
+    def enable_compression(self, compression=True, threshold=compress.COMPRESS_THRESHOLD):
+        """
+        Agree on a codec with the peer, after which both ends compress frames
+        of at least `threshold` bytes. `compression` is as for
+        `compress.offer()`, returns the codec name or None.
+        """
+        name = self.enable_compression_endpoint(compress.offer(compression), threshold)
+        if name is not None:
+            self.codec = compress.CODECS[name]
+            self.compress_threshold = threshold
+        return name
+
+    def enable_chunking(self, size=CHUNK_SIZE):
+        """
+        Have both ends send frames larger than `size` bytes in chunks of at
+        most that much.
+        """
+        self.enable_chunking_endpoint(size)
+        self.chunk_size = size
+
+    def enable_metrics(self, callback=None):
+        """
+        Collect metrics for this end of the connection from now on, returns
+        the `Metrics`. `callback` gets every completed top-level call.
+        """
+        if self.metrics is None:
+            self.metrics = Metrics(callback)
+        return self.metrics
+
+    def start(self):
+        """
+        Run the reader on a background thread, for the side that makes calls
+        from its own threads (the client).
+        """
+        assert self.reader is None
+        self.reader = threading.Thread(target=self.serve, name="glass-reader", daemon=True)
+        self.reader.start()
+        return self
+
+    def serve(self):
+        """
+        Run the reader on the current thread until the connection closes.
+        """
+        self.reader = threading.current_thread()
+        try:
+            while True:
+                self.pump()
+        except (EOFError, OSError):
+            logger.debug("reader: connection closed")
+        finally:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        for req_id in list(self.pending):
+            slot = self.pending.pop(req_id, None)
+            if slot is not None:
+                slot.fail(EOFError("connection closed"))
+        self.executor.shutdown(wait=False)
+        self.lane.shutdown(wait=False)
+        self.deadlines.close()
+        self.streams.clear()
+        while self.fds:
+            os.close(self.fds.popleft())
+
+    def pump(self):
+        """
+        Read whatever is available on the socket and dispatch every complete frame.
+        """
+        view = memoryview(self.recv_buf)
+        if self.conn.family == socket.AF_UNIX:
+            n, fds = local.recv_fds_into(self.conn, view)
+            self.fds.extend(fds)
+        else:
+            n = self.conn.recv_into(view)
+        if not n:
+            raise EOFError
+
+        # the unpacker copies, so the buffer is free to reuse
+        self.unpacker.feed(view[:n])
+        if n == len(self.recv_buf) and n < RECV_MAX:
+            self.recv_buf = bytearray(2 * n)
+        metrics = self.metrics
+        pos = self.unpacker.tell()
+        for req in self.unpacker:
+            # announced buffers belong to the frame just unpacked
+            self.incoming = None
+            if metrics is not None and req[0] != ReqType.CHUNK.value:
+                nbytes = self.unpacker.tell() - pos
+                if req[0] in (ReqType.BUFFERS.value, ReqType.SHM_BUFFERS.value):
+                    nbytes += sum(req[1])
+                metrics.frame_in(ReqType(req[0]).name, nbytes)
+            self.dispatch[req[0]](req)
+            pos = self.unpacker.tell()
+
+    def on_buffers(self, req):
+        self.incoming = [self.recv_buffer(n) for n in req[1]]
+
+    def on_shm_buffers(self, req):
+        self.incoming = local.map_buffers(self.fds.popleft(), req[1])
+
+    def on_chunk(self, req):
+        stream_id, n = req[1], req[2]
+        if len(req) > 3:
+            # the first chunk says how big the parts are
+            self.streams[stream_id] = Incoming(req[3])
+        stream = self.streams[stream_id]
+        for view in stream.take(n):
+            self.recv_exactly(view)
+        if not stream.complete():
+            return
+
+        del self.streams[stream_id]
+        *self.incoming, packet = stream.parts
+        req = msgpack.unpackb(packet, ext_hook=self.ext_hooks, strict_map_key=False)
+        if self.metrics is not None:
+            nbytes = sum(len(part) for part in stream.parts)
+            self.metrics.frame_in(ReqType(req[0]).name, nbytes)
+        self.dispatch[req[0]](req)
+
+    def on_call(self, req):
+        req_id, cmd, args, kwargs = req[1:5]
+        root = req[5] if len(req) > 5 else None
+        timeout = req[6] if len(req) > 6 else None
+        if root is not None and self.metrics is not None:
+            self.metrics.count_nested(root, cmd)
+        if req_id is None:
+            self.last_notify = self.submit(
+                self.handle, req_id, cmd, args, kwargs, None, root, executor=self.lane
+            )
+        else:
+            after = self.last_notify
+            if after is not None and after.done():
+                after = None
+            # from the peer's clock to ours
+            deadline = None if timeout is None else time.monotonic() + timeout
+            self.running[req_id] = Running(cmd, deadline)
+            if deadline is not None:
+                self.deadlines.add(deadline, req_id)
+            self.submit(self.handle, req_id, cmd, args, kwargs, after, root)
+
+    def on_cancel(self, req):
+        self.cancel_running(req[1], "cancel")
+
+    def cancel_running(self, req_id, why):
+        """
+        Stop a call from the peer: interrupt it if it's running, skip it if it
+        hasn't started, nothing if it's been answered.
+        """
+        with self.running_lock:
+            call = self.running.get(req_id)
+            if call is None or call.cancelled is not None:
+                return
+            call.cancelled = why
+            if call.thread is not None:
+                logger.debug(f"interrupting {call.cmd} ({req_id}): {why}")
+                interrupt(call.thread)
+
+    def on_ret(self, req):
+        self.resolve(req[1], req[2], None)
+
+    def on_err(self, req):
+        self.resolve(req[1], None, pickle.loads(req[2]))
+
+    def recv_buffer(self, n):
+        """
+        Read an `n` byte raw buffer into fresh memory.
+        """
+        buf = bytearray(n)
+        self.recv_exactly(memoryview(buf))
+        return buf
+
+    def recv_exactly(self, view):
+        """
+        Fill `view` with raw bytes, taking what the unpacker already buffered
+        first and the rest straight from the socket.
+        """
+        n = view.nbytes
+        head = self.unpacker.read_bytes(n)
+        view[: len(head)] = head
+        pos = len(head)
+        while pos < n:
+            got = self.conn.recv_into(view[pos:])
+            if not got:
                 raise EOFError
+            pos += got
 
-            self.unpacker.feed(resp)
-            for req in self.unpacker:
-                req_type = ReqType(req[0])
-                req = req[1:]
-                if req_type == ReqType.CALL:
-                    cmd, args, kwargs = req
-                    resp = self.endpoints[cmd](*args, **kwargs)
-                    resp = (ReqType.RET.value, resp)
-                    self.conn.send(msgpack.packb(resp))
-                elif req_type == ReqType.RET:
-                    ret = req[0]
-                    self.queue.append(ret)
-                elif req_type == ReqType.ERR:
-                    s = req[0]
-                    exc = pickle.loads(s)
-                    raise exc
-
-        return self.queue.pop(0)
-
-    def exception(self, exc):
+    def incoming_buffer(self, data):
+        return self.incoming[msgpack.unpackb(data)]
+
+    def resolve(self, req_id, value, error):
+        if req_id is None:
+            logger.warning(f"one-way call failed: {error!r}")
+            self.notify_errors.append(error)
+            return
+        with self.cancel_lock:
+            slot = self.pending.pop(req_id, None)
+        if slot is None:
+            # late reply for a call that was already failed by close()
+            logger.debug(f"dropping reply for unknown request {req_id}")
+            return
+        if slot.started is not None:
+            elapsed = time.perf_counter() - slot.started
+            self.metrics.call_done(slot.name, elapsed, error is not None, slot.root)
+        name = slot.name
+        if slot.profile is not None and error is None:
+            report, name, sent = slot.profile
+            value, stats, seconds = value
+            report.add(name, stats, seconds, time.perf_counter() - sent)
+        if slot.cancelled:
+            if error is None:
+                self.dropped(name, value)
+            return
+        if error is not None:
+            slot.fail(error)
+        else:
+            slot.resolve(value)
+
+    def submit(self, fn, *args, executor=None):
+        """
+        Run `fn` on a worker thread, used for anything that may block on a call.
+        """
+        try:
+            return (executor or self.executor).submit(fn, *args)
+        except RuntimeError:
+            # executor shut down, the connection is closed
+            logger.debug(f"dropping {fn.__name__}{args}: connection closed")
+            return None
+
+    def handle(self, req_id, cmd, args, kwargs, after=None, root=None):
+        call = None if req_id is None else self.running.get(req_id)
+        context = self.context
+        outer = getattr(context, "root", None), getattr(context, "deadline", None)
+        context.root = root
+        context.deadline = None if call is None else call.deadline
+        started = time.perf_counter()
+        failed = False
+        try:
+            if after is not None:
+                # one-way calls sent before this one
+                after.result()
+            if call is None:
+                resp = self.endpoints[cmd](*args, **kwargs)
+            else:
+                resp = self.run(call, args, kwargs)
+            if req_id is not None:
+                self.send((ReqType.RET.value, req_id, resp))
+        except BaseException as e:
+            failed = True
+            # always answer, otherwise the caller waits forever
+            self.exception(req_id, e)
+        finally:
+            self.running.pop(req_id, None)
+            if call is not None and call.deadline is not None:
+                self.deadlines.discard(req_id)
+            context.root, context.deadline = outer
+            if self.metrics is not None:
+                self.metrics.handled(cmd, time.perf_counter() - started, failed)
+
+    def run(self, call, args, kwargs):
+        """
+        Run a call's endpoint where `cancel_running()` can interrupt it.
+        """
+        with self.running_lock:
+            if call.cancelled is None and call.deadline is not None:
+                if call.deadline <= time.monotonic():
+                    call.cancelled = "deadline"
+            if call.cancelled is not None:
+                raise call.error()
+            call.thread = threading.get_ident()
+        try:
+            return self.endpoints[call.cmd](*args, **kwargs)
+        except Cancelled:
+            raise call.error() from None
+        finally:
+            with self.running_lock:
+                if call.cancelled is not None:
+                    # returned before it went off
+                    interrupt(call.thread, None)
+                call.thread = None
+
+    def exception(self, req_id, exc):
         try:
-            raise exc
-        except KeyError as e:
-            raise e
+            self.send((ReqType.ERR.value, req_id, pack_exception(exc)))
         except Exception:
-            pass
+            logger.exception(f"could not send error for request {req_id}")
+
+    def send(self, packet):
+        kind = packet[0]
+        buffers = []
+        packet = msgpack.packb(packet, default=lambda obj: pack_default(obj, buffers))
+        if self.codec is not None:
+            packet = compress.compress(self.codec, packet, self.compress_threshold)
+        nbytes = len(packet) + sum(b.nbytes for b in buffers)
+        if self.metrics is not None:
+            self.metrics.frame_out(ReqType(kind).name, nbytes)
+        if buffers and self.shm and nbytes - len(packet) >= local.SHM_THRESHOLD:
+            # one copy into shared memory, the peer maps it instead of reading it
+            fd = local.share_buffers(buffers)
+            try:
+                header = msgpack.packb((ReqType.SHM_BUFFERS.value, [b.nbytes for b in buffers]))
+                with self.send_lock:
+                    self.flush()
+                    sendmsg_all(self.conn, [header, packet], local.fds_message([fd]))
+            finally:
+                os.close(fd)
+            return
+
+        if self.chunk_size is not None and nbytes > self.chunk_size:
+            self.send_chunked(buffers, packet)
+            return
+
+        if buffers:
+            header = msgpack.packb((ReqType.BUFFERS.value, [b.nbytes for b in buffers]))
+            self.outbox.append((header, *buffers, packet))
+        else:
+            self.outbox.append((packet,))
+        with self.send_lock:
+            # may find our frame already sent along with another thread's
+            self.flush()
+
+    def send_chunked(self, buffers, packet):
+        """
+        Send a large frame as CHUNK frames of at most `chunk_size` bytes, its
+        buffers first and then the frame itself, straight from their memory.
+        Every chunk takes the send lock on its own, so the frames other threads
+        queue meanwhile go out between them, and concurrent large frames take
+        turns.
+        """
+        stream_id = next(self.stream_ids)
+        parts = deque(memoryview(b).cast("B") for b in [*buffers, packet])
+        sizes = [part.nbytes for part in parts]
+        while parts:
+            views = []
+            room = self.chunk_size
+            while parts and room:
+                view = parts.popleft()
+                if view.nbytes > room:
+                    parts.appendleft(view[room:])
+                    view = view[:room]
+                views.append(view)
+                room -= view.nbytes
+            header = [ReqType.CHUNK.value, stream_id, self.chunk_size - room]
+            if sizes is not None:
+                header.append(sizes)
+                sizes = None
+            self.chunk_outbox.append((msgpack.packb(header), *views))
+            with self.send_lock:
+                self.flush()
+
+    def flush(self):
+        """
+        Write every queued frame in one go, with the send lock held. Whole
+        frames go ahead of the chunks of large ones.
+        """
+        chunks = []
+        while self.outbox:
+            chunks.extend(self.outbox.popleft())
+        while self.chunk_outbox:
+            chunks.extend(self.chunk_outbox.popleft())
+        if len(chunks) == 1:
+            self.conn.sendall(chunks[0])
+        elif chunks:
+            sendmsg_all(self.conn, chunks)
+
+    def wait(self, slot):
+        if threading.current_thread() is self.reader:
+            raise RuntimeError("blocking call from the reader thread, use submit()")
+        try:
+            if slot.deadline is None:
+                slot.event.wait()
+            elif not slot.event.wait(max(0.0, slot.deadline - time.monotonic())):
+                if self.cancel(slot):
+                    raise TimeoutError(f"{slot.name} ran past its deadline")
+                # the reply beat the deadline after all
+                slot.event.wait()
+        except KeyboardInterrupt:
+            if not self.cancel(slot):
+                slot.event.wait()
+                if slot.error is None:
+                    self.dropped(slot.name, slot.value)
+            raise
+
+        if slot.error is not None:
+            raise slot.error
+        return slot.value
+
+    def cancel(self, slot):
+        """
+        Give up on a call that hasn't been answered: its reply will be dropped,
+        and the peer is asked to stop it. False if it has been answered.
+        """
+        with self.cancel_lock:
+            if self.pending.get(slot.req_id) is not slot:
+                return False
+            slot.cancelled = True
+        if self.live():
+            try:
+                self.send((ReqType.CANCEL.value, slot.req_id))
+            except OSError:
+                pass
+        return True
+
+    def dropped(self, name, value):
+        if self.on_dropped is not None:
+            self.submit(self.on_dropped, name, value)
+
+    @contextmanager
+    def deadline(self, seconds):
+        """
+        Calls this thread makes inside the block must be answered within
+        `seconds` of entering it, or raise TimeoutError.
+        """
+        context = self.context
+        outer = getattr(context, "deadline", None)
+        deadline = time.monotonic() + seconds
+        context.deadline = deadline if outer is None else min(outer, deadline)
+        try:
+            yield
+        finally:
+            context.deadline = outer
+
+    def notify(self, name, *args, **kwargs):
+        """
+        Call endpoint `name` without waiting, a failure is raised by the next call.
+        """
+        if self.closed:
+            raise EOFError("connection closed")
+        self.send(self.call_frame(None, name, args, kwargs, self.nested_root(name)))
+
+    def nested_root(self, name):
+        """
+        Root token for a call made from this thread, counted as nested when
+        metrics are on and it's one of ours.
+        """
+        root = getattr(self.context, "root", None)
+        if root is not None and self.metrics is not None:
+            self.metrics.count_nested(root, name)
+        return root
+
+    def call_frame(self, req_id, name, args, kwargs, root, timeout=None):
+        if timeout is not None:
+            return (ReqType.CALL.value, req_id, name, args, kwargs, root, timeout)
+        if root is None:
+            return (ReqType.CALL.value, req_id, name, args, kwargs)
+        return (ReqType.CALL.value, req_id, name, args, kwargs, root)
 
-        s = pickle.dumps(exc)
-        self.conn.send(msgpack.packb([ReqType.ERR.value, s]))
+    def begin(self, name, args, kwargs, on_done=None):
+        """
+        Send a call without waiting for it, `wait()` on the returned slot gets
+        its result. `on_done(slot)` runs once it's done, see `Pending`.
+        """
+        if self.notify_errors:
+            raise self.notify_errors.popleft()
+        req_id = next(self.ids)
+        slot = Pending(on_done)
+        report = getattr(self.context, "profile", None)
+        if report is not None:
+            # run under the server's profiler, see Remote.profile()
+            slot.profile = (report, name, time.perf_counter())
+            name, args, kwargs = "profile_endpoint", (name, args, kwargs), {}
+        root = self.nested_root(name)
+        if self.metrics is not None:
+            if root is None:
+                # top-level, whatever it sets off is counted against it
+                root = slot.root = self.metrics.new_root()
+            slot.started = time.perf_counter()
+        slot.name = name
+        slot.req_id = req_id
+        timeout = None
+        deadline = getattr(self.context, "deadline", None)
+        if self.timeout is not None:
+            own = time.monotonic() + self.timeout
+            deadline = own if deadline is None else min(deadline, own)
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise TimeoutError(f"{name}: deadline already passed")
+            slot.deadline = deadline
+        self.pending[req_id] = slot
+        if self.closed:
+            del self.pending[req_id]
+            raise EOFError("connection closed")
+        self.send(self.call_frame(req_id, name, args, kwargs, root, timeout))
+        return slot
 
     def __getattr__(self, name):
         def call(*args, **kwargs):
-            packet = (ReqType.CALL.value, name, args, kwargs)
-            packet = msgpack.packb(packet)
-            self.conn.send(packet)
-            resp = self.recv()
-            logger.debug(f"{name} -> ({fmt_args_kwargs(args, kwargs)}) -> {pretty(resp)}")
+            resp = self.wait(self.begin(name, args, kwargs))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{name} -> ({fmt_args_kwargs(args, kwargs)}) -> {pretty(resp)}")
             return resp
 
         return call
@@ -1,7 +1,16 @@
 import sys
+import queue
+import pickle
+import weakref
 import socket
+import itertools
+from collections import deque
 from .serdes import Serializer
-from .bidirpc import BidirPC
+from .bidirpc import BidirPC, CHUNK_SIZE
+from .local import connect
+from .compress import COMPRESS_THRESHOLD
+from .profiling import ProfileReport
+from . import session as sessions
 import logging
 
 # logging.basicConfig(
@@ -11,21 +20,207 @@ import logging
 # logger = logging.getLogger(__name__)
 
 
+def disconnect(rpc, conn):
+    rpc.close()
+    try:
+        # wakes the reader blocked in recv()
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    conn.close()
+
+
 class Remote:
-    def __init__(self, host, port):
-        self.conn = socket.create_connection((host, port))
+    def __init__(
+        self,
+        host,
+        port,
+        local=None,
+        shm=True,
+        compression=None,
+        compress_threshold=COMPRESS_THRESHOLD,
+        metrics=False,
+        chunk_size=CHUNK_SIZE,
+        timeout=None,
+        session=None,
+    ):
+        self.address = (host, port, local)
+        self.options = {
+            "shm": shm,
+            "compression": compression,
+            "compress_threshold": compress_threshold,
+            "metrics": metrics,
+            "chunk_size": chunk_size,
+            "timeout": timeout,
+        }
+        # True for a server session that survives reconnects, or the token of one
+        if isinstance(session, str):
+            session = bytes.fromhex(session)
+        self.session = session
+        # whether the last connection found the session as it was left
+        self.resumed = False
+        self.open()
+        self.ser = Serializer(self.rpc)
 
+    def open(self):
+        # a Unix socket plus shared memory when the server is on this machine
+        self.conn = connect(*self.address)
+        if self.session:
+            token = None if self.session is True else self.session
+            self.session, self.resumed = sessions.hello(self.conn, token)
+
+        options = self.options
         self.rpc = BidirPC()
-        self.rpc.connect(self.conn)
+        self.rpc.connect(self.conn).start()
+        if options["shm"]:
+            self.rpc.enable_shm()
+        # seconds any one call may take before it's cancelled, see deadline()
+        self.rpc.timeout = options["timeout"]
+        # large frames in chunks, so they don't hold up the calls behind them
+        if options["chunk_size"]:
+            self.rpc.enable_chunking(options["chunk_size"])
+        # for slow links: True, or codec names in order of preference
+        if options["compression"]:
+            self.rpc.enable_compression(options["compression"], options["compress_threshold"])
+        # True, or a callback for every completed top-level call, see glass.metrics
+        metrics = options["metrics"]
+        if metrics:
+            self.rpc.enable_metrics(None if metrics is True else metrics)
+            self.rpc.enable_metrics_endpoint()
 
-        self.ser = Serializer(self.rpc)
+        # runs on close(), garbage collection or interpreter exit, without keeping self alive
+        self.finalizer = weakref.finalize(self, disconnect, self.rpc, self.conn)
+
+    def reconnect(self):
+        """
+        Drop the connection and open a new one. With a session, returns whether
+        the server still had it: captured functions and remote objects keep
+        working if so, and must be captured again otherwise.
+        """
+        self.finalizer()
+        self.open()
+        self.ser.attach(self.rpc)
+        return self.resumed
+
+    @property
+    def token(self):
+        """
+        The session's token, for `Remote(..., session=token)` from another process.
+        """
+        return None if not self.session else self.session.hex()
+
+    def close(self):
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ref_stats(self):
+        """
+        The server's accounting of the objects it holds for this connection.
+        """
+        return self.rpc.ref_stats_endpoint()
 
-    def capture(self, obj):
+    def metrics(self, server=False):
+        """
+        Snapshot of this connection's metrics, as seen by the client or, with
+        `server`, by the server. None unless created with `metrics`.
+        """
+        if server:
+            return self.rpc.metrics_endpoint()
+        return None if self.rpc.metrics is None else self.rpc.metrics.snapshot()
+
+    def deadline(self, seconds):
+        """
+        Cancel the calls this thread makes inside the block once `seconds`
+        have passed, on both ends, raising TimeoutError:
+
+            with remote.deadline(2.0):
+                result = slow_job(data)
+        """
+        return self.rpc.deadline(seconds)
+
+    def profile(self):
+        """
+        Profile the calls this thread makes inside the block, on both ends:
+
+            with remote.profile() as report:
+                result = slow_job(data)
+            print(report)
+        """
+        return ProfileReport().collect(self.rpc)
+
+    def memo_stats(self):
+        """
+        Hits, misses and size of the server's result cache for `capture(cache=...)`.
+        """
+        return self.rpc.memo_stats_endpoint()
+
+    def capture(self, obj=None, cache=False):
+        """
+        Ship `obj` to the server, returns a stub for it. With `cache`, a pure
+        function whose results the server keeps, for `cache` seconds unless
+        it's just True, and shares between all its clients. Without `obj`, a
+        decorator: `@remote.capture(cache=60)`.
+        """
+        if obj is None:
+            return lambda obj: self.capture(obj, cache)
         # raise exception if obj is a method in a class
         if hasattr(obj, "__qualname__") and "." in obj.__qualname__:
             raise Exception("cannot capture bound method")
 
         ser = self.ser.serialize(obj)
-        stub = self.rpc.add_obj(ser, to_global=True)
+        if cache:
+            ttl = None if cache is True else float(cache)
+            stub = self.rpc.add_obj(ser, to_global=True, cache=True, ttl=ttl)
+        else:
+            stub = self.rpc.add_obj(ser, to_global=True)
         stub = self.ser.deserialize(stub)
         return stub
+
+    def map(self, func, iterable, chunksize=256, ordered=True, window=4):
+        """
+        map() on the server: `func` is shipped once, the input is sent in chunks
+        of `chunksize` items that the server runs in a loop, and results come
+        back as a generator. Up to `window` chunks are in flight, the input is
+        read no further ahead than that. With `ordered=False` chunks are yielded
+        as they complete.
+        """
+        return self.map_chunks(func, iterable, False, chunksize, ordered, window)
+
+    def starmap(self, func, iterable, chunksize=256, ordered=True, window=4):
+        """
+        `map()` for argument tuples, like itertools.starmap().
+        """
+        return self.map_chunks(func, iterable, True, chunksize, ordered, window)
+
+    def map_chunks(self, func, iterable, star, chunksize, ordered, window):
+        iterable = iter(iterable)
+        chunks = iter(lambda: list(itertools.islice(iterable, chunksize)), [])
+        done = None if ordered else queue.SimpleQueue()
+        on_done = None if ordered else done.put
+        in_flight = deque()
+
+        def send(chunk):
+            # after the first chunk, only the digest of a function without closure
+            args = (self.ser.serialize(func), self.ser.serialize(chunk), star)
+            in_flight.append(self.rpc.begin("map_chunk", args, {}, on_done))
+
+        for chunk in itertools.islice(chunks, window):
+            send(chunk)
+        while in_flight:
+            if ordered:
+                slot = in_flight.popleft()
+            else:
+                slot = done.get()
+                in_flight.remove(slot)
+            results, error = self.rpc.wait(slot)
+            # ask for the next chunk before working through this one
+            for chunk in itertools.islice(chunks, 1):
+                send(chunk)
+            yield from self.ser.deserialize(results)
+            if error is not None:
+                raise pickle.loads(error)
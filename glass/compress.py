@@ -0,0 +1,118 @@
+"""
+Frame compression, negotiated per connection. A compressed frame travels as a
+COMPRESSED ext wrapping the whole packed frame, its first byte names the codec,
+and the peer's unpacker expands it in place of the frame.
+"""
+
+import zlib
+import lzma
+import logging
+import msgpack
+from .types import ExtCode
+
+logger = logging.getLogger(__name__)
+
+# frames smaller than this go out as they are
+COMPRESS_THRESHOLD = 1 << 14
+# large frames are probed with this much of their start first
+PROBE_SIZE = 1 << 16
+# compressed data must be at most this fraction of the original to be sent
+MAX_RATIO = 0.9
+# tried in this order when compression is just turned on, lzma must be asked for
+PREFERENCE = ("zstd", "lz4", "zlib")
+
+
+class Codec:
+    __slots__ = ("name", "code", "compress", "decompress")
+
+    def __init__(self, name, code, compress, decompress):
+        self.name = name
+        self.code = code
+        self.compress = compress
+        self.decompress = decompress
+
+
+CODECS = {}
+BY_CODE = {}
+
+
+def register(name, code, compress, decompress):
+    codec = CODECS[name] = BY_CODE[code] = Codec(name, code, compress, decompress)
+    return codec
+
+
+register("zlib", 0, lambda data: zlib.compress(data, 1), zlib.decompress)
+register("lzma", 1, lambda data: lzma.compress(data, preset=1), lzma.decompress)
+
+# faster codecs, when available
+try:
+    from compression import zstd
+
+    register("zstd", 2, lambda data: zstd.compress(data, 3), zstd.decompress)
+except ImportError:
+    try:
+        import zstandard
+
+        register("zstd", 2, lambda data: zstandard.compress(data, 3), zstandard.decompress)
+    except ImportError:
+        pass
+
+try:
+    import lz4.frame
+
+    register("lz4", 3, lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+def offer(compression):
+    """
+    Codec names to propose to the peer, best first: `True` for the available
+    ones in `PREFERENCE`, or a name or list of names.
+    """
+    if compression is True:
+        return [name for name in PREFERENCE if name in CODECS]
+    names = [compression] if isinstance(compression, str) else list(compression)
+    for name in names:
+        if name not in CODECS:
+            raise ValueError(f"compression codec {name!r} is not available")
+    return names
+
+
+def choose(names):
+    """
+    The first of the peer's proposed codecs that we have.
+    """
+    for name in names:
+        if name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def worth_it(codec, packet):
+    if len(packet) <= 4 * PROBE_SIZE:
+        return True
+    # images, archives, random data: don't spend a full pass finding out
+    probe = memoryview(packet)[:PROBE_SIZE]
+    return len(codec.compress(probe)) <= PROBE_SIZE * MAX_RATIO
+
+
+def compress(codec, packet, threshold=COMPRESS_THRESHOLD):
+    """
+    `packet` as a COMPRESSED frame, or unchanged when it's small or doesn't
+    compress well enough.
+    """
+    if len(packet) < threshold or not worth_it(codec, packet):
+        return packet
+    data = codec.compress(packet)
+    if len(data) > len(packet) * MAX_RATIO:
+        return packet
+    logger.debug(f"{codec.name}: {len(packet)} -> {len(data)} bytes")
+    return msgpack.packb(msgpack.ExtType(ExtCode.COMPRESSED.value, bytes((codec.code,)) + data))
+
+
+def decompress(data):
+    codec = BY_CODE.get(data[0])
+    if codec is None:
+        raise ValueError(f"unknown compression codec {data[0]}")
+    return codec.decompress(memoryview(data)[1:])
@@ -0,0 +1,129 @@
+"""
+Same-host transport: a Unix socket next to the TCP port, and memfd-backed shared
+memory for large buffers, passed over that socket as file descriptors.
+"""
+
+import os
+import mmap
+import array
+import socket
+import tempfile
+import ipaddress
+import logging
+
+logger = logging.getLogger(__name__)
+
+# frames whose raw buffers add up to this much go through shared memory
+SHM_THRESHOLD = 1 << 20
+# buffer offsets in the shared segment, keeps NumPy data aligned
+SHM_ALIGN = 64
+# file descriptors a single recvmsg() makes room for
+MAX_FDS = 16
+MAP_POPULATE = getattr(mmap, "MAP_POPULATE", 0)
+
+
+def socket_path(port):
+    return os.path.join(tempfile.gettempdir(), f"glass-{port}.sock")
+
+
+def is_local(host):
+    try:
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(info[4][0]).is_loopback for info in infos)
+
+
+def listen_local(port, backlog=5):
+    path = socket_path(port)
+    if os.path.exists(path):
+        # left over by a server that didn't shut down cleanly
+        os.unlink(path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(backlog)
+    return s
+
+
+def connect(host, port, local=None):
+    """
+    Connect over the Unix socket when `host` is this machine and the server
+    listens on one, over TCP otherwise. `local=False` forces TCP.
+    """
+    if local is None:
+        local = is_local(host)
+    if local:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(socket_path(port))
+            return s
+        except OSError as e:
+            logger.debug(f"no local socket for port {port} ({e}), using TCP")
+            s.close()
+    return socket.create_connection((host, port))
+
+
+def can_share(conn):
+    return conn.family == socket.AF_UNIX and hasattr(os, "memfd_create")
+
+
+def layout(sizes):
+    offsets, end = [], 0
+    for n in sizes:
+        offsets.append(end)
+        end += -(-n // SHM_ALIGN) * SHM_ALIGN
+    return offsets, end
+
+
+def share_buffers(buffers):
+    """
+    Copy `buffers` into a fresh shared memory segment, returns its descriptor.
+    """
+    offsets, size = layout([b.nbytes for b in buffers])
+    fd = os.memfd_create("glass-buffers", os.MFD_CLOEXEC)
+    try:
+        os.ftruncate(fd, size)
+        # written by the kernel, no page faults on a mapping of our own
+        for offset, b in zip(offsets, buffers):
+            view = memoryview(b).cast("B")
+            while view.nbytes:
+                written = os.pwrite(fd, view, offset)
+                view, offset = view[written:], offset + written
+    except BaseException:
+        os.close(fd)
+        raise
+    return fd
+
+
+def map_buffers(fd, sizes):
+    """
+    Views on the buffers in a segment from `share_buffers`. The mapping stays
+    alive as long as any of them does.
+    """
+    offsets, size = layout(sizes)
+    try:
+        # populated up front, faulting pages in one by one costs more than the copy
+        view = memoryview(mmap.mmap(fd, size, flags=mmap.MAP_SHARED | MAP_POPULATE))
+    finally:
+        os.close(fd)
+    return [view[offset : offset + n] for offset, n in zip(offsets, sizes)]
+
+
+def fds_message(fds):
+    return [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+
+
+def recv_fds_into(conn, view):
+    """
+    recv_into() that also collects file descriptors passed along with the data.
+    """
+    n, ancdata, flags, _ = conn.recvmsg_into([view], socket.CMSG_SPACE(MAX_FDS * 4))
+    fds = array.array("i")
+    for level, kind, payload in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(payload[: len(payload) - len(payload) % fds.itemsize])
+    if flags & socket.MSG_CTRUNC:
+        for fd in fds:
+            os.close(fd)
+        raise OSError("file descriptors dropped by recvmsg")
+    return n, list(fds)
@@ -0,0 +1,207 @@
+"""
+Result cache for captured functions marked pure, `Remote.capture(func, cache=...)`.
+
+Results are pickled and keyed by the function's content digest plus its pickled
+arguments, so identical calls from any client hit the same entry. Under
+`glass.server` the cache lives in a process of its own that outlives the
+per-connection children, which reach it over a Unix socket.
+"""
+
+import io
+import os
+import time
+import pickle
+import socket
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from .bidirpc import BidirPC
+from .netobj import NetworkObj
+
+logger = logging.getLogger(__name__)
+
+
+class NotCacheable(Exception):
+    pass
+
+
+class MemoCache:
+    """
+    Thread-safe LRU of pickled results, bounded by entry count and total bytes,
+    entries past their own TTL are dropped on access.
+    """
+
+    def __init__(self, max_entries=4096, max_bytes=256 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (pickled result, expiry or None), least recently used first
+        self.data = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "evicted": 0, "expired": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.monotonic():
+                self.discard(key)
+                self.counts["expired"] += 1
+                entry = None
+            if entry is None:
+                self.counts["misses"] += 1
+                return None
+            self.data.move_to_end(key)
+            self.counts["hits"] += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=None):
+        if len(value) > self.max_bytes:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.discard(key)
+            self.data[key] = (value, expires)
+            self.size += len(value)
+            while len(self.data) > self.max_entries or self.size > self.max_bytes:
+                self.discard(next(iter(self.data)))
+                self.counts["evicted"] += 1
+
+    def discard(self, key):
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.data), "bytes": self.size, **self.counts}
+
+
+def cache_path(port):
+    return os.path.join(tempfile.gettempdir(), f"glass-{port}.memo.sock")
+
+
+def listen_cache(port):
+    path = cache_path(port)
+    if os.path.exists(path):
+        os.unlink(path)
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(path)
+    s.listen(64)
+    return s
+
+
+def serve_cache(listener, cache):
+    """
+    Serve `cache` to every process that connects to `listener`, until killed.
+    """
+    while True:
+        conn, _ = listener.accept()
+        rpc = BidirPC(max_workers=4)
+        rpc.connect(conn)
+        rpc.endpoints.update(memo_get=cache.get, memo_put=cache.put, memo_stats=cache.stats)
+        threading.Thread(target=rpc.serve, name="glass-memo", daemon=True).start()
+
+
+class SharedCache:
+    """
+    `MemoCache` interface to the cache process listening at `path`. Connects on
+    first use in each process, and falls back to a cache of its own when the
+    cache process can't be reached.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.rpc = None
+        self.fallback = None
+        self.lock = threading.Lock()
+
+    def remote(self):
+        with self.lock:
+            if self.pid != os.getpid() or not (self.fallback or self.rpc.live()):
+                # first use since a fork, or the cache process went away
+                self.pid = os.getpid()
+                self.rpc = self.fallback = None
+                conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    conn.connect(self.path)
+                    self.rpc = BidirPC(max_workers=1).connect(conn).start()
+                except OSError as e:
+                    logger.warning(f"memo cache {self.path} unreachable ({e}), using a local one")
+                    conn.close()
+                    self.fallback = MemoCache()
+            return self.rpc, self.fallback
+
+    def get(self, key):
+        rpc, fallback = self.remote()
+        return fallback.get(key) if fallback else rpc.memo_get(key)
+
+    def put(self, key, value, ttl=None):
+        rpc, fallback = self.remote()
+        if fallback:
+            fallback.put(key, value, ttl)
+        else:
+            rpc.notify("memo_put", key, value, ttl)
+
+    def stats(self):
+        rpc, fallback = self.remote()
+        return fallback.stats() if fallback else rpc.memo_stats()
+
+
+class Memoized:
+    """
+    `func` with its results cached in `cache` for `ttl` seconds, or until
+    evicted. Calls whose arguments or result can't be pickled are not cached.
+    """
+
+    def __init__(self, func, digest, cache, ttl=None):
+        self.func = func
+        self.digest = digest
+        self.cache = cache
+        self.ttl = ttl
+        self.__name__ = func.__name__
+        self.__qualname__ = func.__qualname__
+        self.__module__ = func.__module__
+        self.__doc__ = func.__doc__
+        self.__wrapped__ = func
+
+    def __call__(self, *args, **kwargs):
+        try:
+            key = self.key(args, kwargs)
+        except (NotCacheable, TypeError, pickle.PicklingError, AttributeError) as e:
+            logger.debug(f"{self.__qualname__}: not cached, {e}")
+            return self.func(*args, **kwargs)
+
+        value = self.cache.get(key)
+        if value is not None:
+            return pickle.loads(value)
+        result = self.func(*args, **kwargs)
+        try:
+            self.cache.put(key, pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL), self.ttl)
+        except (TypeError, pickle.PicklingError, AttributeError) as e:
+            logger.debug(f"{self.__qualname__}: result not cached, {e}")
+        return result
+
+    def key(self, args, kwargs):
+        h = hashlib.blake2b(self.digest, digest_size=20)
+        h.update(dumps_args((args, sorted(kwargs.items()))))
+        return h.digest()
+
+    def __repr__(self):
+        return f"<memoized {self.func!r}>"
+
+
+class ArgPickler(pickle.Pickler):
+    # a stub stands for state on the other end, it has no value to key on
+    def persistent_id(self, obj):
+        if isinstance(obj, NetworkObj):
+            raise NotCacheable("argument is a remote object")
+        return None
+
+
+def dumps_args(args):
+    buf = io.BytesIO()
+    ArgPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(args)
+    return buf.getvalue()
@@ -0,0 +1,177 @@
+"""
+Per-connection RPC metrics, see `BidirPC.enable_metrics()`.
+
+Calls made with metrics enabled carry a root token, which the peer copies onto
+every call it makes while handling them, and so on back and forth. The side
+that made the top-level call sees each of those nested calls go out or come in,
+and counts them against it.
+"""
+
+import bisect
+import random
+import threading
+from collections import Counter, defaultdict
+
+# latency bucket upper bounds: 1 us to about 17 s, doubling
+BOUNDS = [2**i * 1e-6 for i in range(25)]
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the `q` quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BOUNDS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            # upper bound in seconds -> count, empty buckets left out
+            "buckets": {b: n for b, n in zip(BOUNDS + [float("inf")], self.counts) if n},
+        }
+
+
+class Metrics:
+    """
+    Call counts and latencies per endpoint, frames and bytes per frame type,
+    and the nested calls caused by each top-level call made from this side.
+
+    `callback`, if given, is called with a dict for every top-level call once
+    it's done: its endpoint, duration, whether it failed, and its nested calls
+    by endpoint. It runs on the reader thread, so it must be quick.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lock = threading.Lock()
+        # endpoint -> latency seen by the caller, and time spent in the handler
+        self.calls_out = defaultdict(Histogram)
+        self.calls_in = defaultdict(Histogram)
+        self.errors_out = Counter()
+        self.errors_in = Counter()
+        # frame type name -> [frames, bytes]
+        self.frames_out = defaultdict(lambda: [0, 0])
+        self.frames_in = defaultdict(lambda: [0, 0])
+        # root token -> nested calls so far, for top-level calls in flight
+        self.roots = {}
+        # top-level endpoint -> [calls, nested calls, most in one], and their endpoints
+        self.nested = defaultdict(lambda: [0, 0, 0])
+        self.nested_by = defaultdict(Counter)
+
+    def new_root(self):
+        root = random.getrandbits(63)
+        with self.lock:
+            self.roots[root] = Counter()
+        return root
+
+    def count_nested(self, root, name):
+        """
+        A call under `root`, in either direction. Roots of the peer's own are
+        none of our business.
+        """
+        with self.lock:
+            calls = self.roots.get(root)
+            if calls is not None:
+                calls[name] += 1
+
+    def call_done(self, name, seconds, failed, root=None):
+        with self.lock:
+            self.calls_out[name].observe(seconds)
+            if failed:
+                self.errors_out[name] += 1
+            if root is None:
+                return
+            calls = self.roots.pop(root, None)
+            if calls is None:
+                return
+            total = sum(calls.values())
+            entry = self.nested[name]
+            entry[0] += 1
+            entry[1] += total
+            entry[2] = max(entry[2], total)
+            self.nested_by[name].update(calls)
+        if self.callback is not None:
+            self.callback(
+                {
+                    "endpoint": name,
+                    "seconds": seconds,
+                    "failed": failed,
+                    "nested": total,
+                    "nested_by": dict(calls),
+                }
+            )
+
+    def handled(self, name, seconds, failed):
+        with self.lock:
+            self.calls_in[name].observe(seconds)
+            if failed:
+                self.errors_in[name] += 1
+
+    def frame_out(self, kind, nbytes):
+        with self.lock:
+            entry = self.frames_out[kind]
+            entry[0] += 1
+            entry[1] += nbytes
+
+    def frame_in(self, kind, nbytes):
+        with self.lock:
+            entry = self.frames_in[kind]
+            entry[0] += 1
+            entry[1] += nbytes
+
+    def snapshot(self):
+        """
+        Everything so far as plain data, latencies in seconds.
+        """
+        with self.lock:
+            return {
+                "calls_out": {
+                    name: {**h.snapshot(), "errors": self.errors_out[name]}
+                    for name, h in self.calls_out.items()
+                },
+                "calls_in": {
+                    name: {**h.snapshot(), "errors": self.errors_in[name]}
+                    for name, h in self.calls_in.items()
+                },
+                "frames_out": frame_counts(self.frames_out),
+                "frames_in": frame_counts(self.frames_in),
+                "nested": {
+                    name: {
+                        "calls": calls,
+                        "nested": total,
+                        "max": most,
+                        "by_endpoint": dict(self.nested_by[name].most_common()),
+                    }
+                    for name, (calls, total, most) in self.nested.items()
+                },
+            }
+
+
+def frame_counts(frames):
+    return {kind: {"frames": n, "bytes": nbytes} for kind, (n, nbytes) in frames.items()}
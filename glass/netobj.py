@@ -1,5 +1,11 @@
+import sys
+import types
 import logging
-from .types import ObjType
+import operator
+import itertools
+from collections import deque
+from .types import AttrKind, ObjType, OpType
+from .bidirpc import pack_exception
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -8,18 +14,239 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# endpoints that answer with one serialized value
+VALUE_ENDPOINTS = frozenset(
+    ["add_obj", "obj_getattr", "obj_call", "obj_call_method", "obj_eval", "obj_iter", "obj_getitem"]
+)
+
+
+def stub_id(stub):
+    """
+    Object id behind a `NetworkObj` (or its async twin), without a remote lookup.
+    """
+    return stub.__dict__[f"_{type(stub).__name__}__glass_obj_id"]
+
+
+class StaleMethod(Exception):
+    """
+    A cached method of a remote object no longer resolves to a method of its class.
+    """
+
+
+def class_method(obj, name):
+    """
+    The plain function `obj.name` resolves to on the class of `obj`, or None if
+    something else answers: an instance attribute, a descriptor, custom lookup.
+    """
+    cls = type(obj)
+    if cls.__getattribute__ is not object.__getattribute__:
+        return None
+    if name in getattr(obj, "__dict__", ()):
+        return None
+    for klass in cls.__mro__:
+        if name in klass.__dict__:
+            attr = klass.__dict__[name]
+            return attr if isinstance(attr, types.FunctionType) else None
+    return None
+
+
+class RemoteMethod:
+    """
+    A method found on the class of a remote object. Calling it is one round trip,
+    and there is no remote bound method to hold a reference to.
+    """
+
+    __slots__ = ("obj", "name")
+
+    def __init__(self, obj, name):
+        self.obj = obj
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        ser = self.obj._NetworkObj__glass_ser
+        args_ser = tuple(ser.serialize(arg) for arg in args)
+        kwargs_ser = {k: ser.serialize(v) for k, v in kwargs.items()}
+        try:
+            resp = ser.rpc.obj_call_method(stub_id(self.obj), self.name, args_ser, kwargs_ser)
+        except StaleMethod:
+            # the class changed, look the attribute up again
+            ser.attr_kinds.pop((self.obj._NetworkObj__glass_cls, self.name))
+            return getattr(self.obj, self.name)(*args, **kwargs)
+        return ser.deserialize(resp)
+
+    def __repr__(self):
+        return f"<remote method {self.name} of object {stub_id(self.obj)}>"
+
+
+class RemoteIterator:
+    """
+    Iterates a remote iterator in batches. The batch size starts at one and
+    doubles up to `batch`, so short or slow iterators stay lazy while long ones
+    pay one round trip per batch. With `readahead` the next batch is requested
+    on a worker thread while the current one is consumed.
+    """
+
+    def __init__(self, ser, stub, batch, readahead):
+        self.ser = ser
+        # holding the stub keeps the remote iterator alive
+        self.stub = stub
+        self.obj_id = stub_id(stub)
+        self.batch = batch
+        self.readahead = readahead
+        self.size = 1
+        self.buffer = deque()
+        self.done = False
+        self.ahead = None
+
+    def fetch(self):
+        size = self.size
+        self.size = min(size * 2, self.batch)
+        return self.ser.rpc.obj_next_batch(self.obj_id, size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.buffer:
+            if self.done:
+                raise StopIteration
+
+            if self.ahead is not None:
+                items, self.done = self.ahead.result()
+                self.ahead = None
+            else:
+                items, self.done = self.fetch()
+            self.buffer.extend(items)
+
+            if self.readahead and not self.done:
+                self.ahead = self.ser.rpc.executor.submit(self.fetch)
+
+        return self.ser.deserialize(self.buffer.popleft())
+
+
+def iterate(stub, batch=None, readahead=None):
+    """
+    Iterate a remote iterable with an explicit prefetch depth and read-ahead,
+    the defaults come from the `Serializer` (`prefetch` and `readahead`).
+    """
+    ser = stub.__dict__["_NetworkObj__glass_ser"]
+    it = ser.deserialize(ser.rpc.obj_iter(stub_id(stub)))
+    if batch is None:
+        batch = ser.prefetch
+    if readahead is None:
+        readahead = ser.readahead
+    return RemoteIterator(ser, it, batch, readahead)
+
+
+class Promise:
+    """
+    Attribute lookups, calls and item lookups on a remote object, recorded
+    instead of sent. The whole chain is evaluated remotely in one round trip when
+    the value is needed: `resolve()`, or converting it with `int()`, `str()`,
+    `len()`, iteration and the like. A promise passed as an argument is evaluated
+    on the remote side as well, without coming back first.
+
+        mean = pipeline(processor).stats["latency"].mean().resolve()
+
+    Dunder lookups aren't recorded, so protocol probes such as
+    `hasattr(p, "__array__")` stay local.
+    """
+
+    def __init__(self, stub, ops):
+        self.__glass_stub = stub
+        self.__glass_ops = ops
+
+    def __getattr__(self, name):
+        if name.startswith("__") and name.endswith("__"):
+            raise AttributeError(name)
+        return Promise(self.__glass_stub, self.__glass_ops + ((OpType.GETATTR, name),))
+
+    def __call__(self, *args, **kwargs):
+        return Promise(self.__glass_stub, self.__glass_ops + ((OpType.CALL, args, kwargs),))
+
+    def __getitem__(self, item):
+        return Promise(self.__glass_stub, self.__glass_ops + ((OpType.GETITEM, item),))
+
+    def resolve(self):
+        stub = self.__glass_stub
+        ser = stub.__dict__["_NetworkObj__glass_ser"]
+        ops = ser.serialize_ops(self.__glass_ops, [])
+        return ser.deserialize(ser.rpc.obj_eval(stub_id(stub), ops))
+
+    def __bool__(self):
+        return bool(self.resolve())
+
+    def __int__(self):
+        return int(self.resolve())
+
+    def __float__(self):
+        return float(self.resolve())
+
+    def __index__(self):
+        return self.resolve().__index__()
+
+    def __str__(self):
+        return str(self.resolve())
+
+    def __len__(self):
+        return len(self.resolve())
+
+    def __iter__(self):
+        return iter(self.resolve())
+
+    def __repr__(self):
+        return f"<Promise of {len(self.__glass_ops)} ops on {stub_id(self.__glass_stub)}>"
+
+
+def pipeline(stub):
+    """
+    Start a `Promise` chain on a remote object.
+    """
+    return Promise(stub, ())
+
+
+def promise_parts(promise):
+    return promise._Promise__glass_stub, promise._Promise__glass_ops
+
 
 class NetworkObj:
-    def __init__(self, ser, obj_id):
+    """
+    Stub for an object the peer passed by reference.
+
+    Methods found on the object's class are remembered per class, after the
+    first lookup calling one is a single round trip. Attributes the class lists
+    in `__glass_immutable__` are cached per stub once fetched.
+    """
+
+    def __init__(self, ser, obj_id, cls_id=None):
         self.__glass_ser = ser
         self.__glass_obj_id = obj_id
+        # identifies the remote class for the method cache
+        self.__glass_cls = cls_id
+        self.__glass_consts = {}
 
     def __getattr__(self, name):
         if name.startswith("__glass_"):
             return super().__getattr__(name)
 
-        ser = self.__glass_ser.rpc.obj_getattr(self.__glass_obj_id, name)
-        return self.__glass_ser.deserialize(ser)
+        ser = self.__glass_ser
+        key = (self.__glass_cls, name)
+        kind = ser.attr_kinds.get(key)
+        if kind == AttrKind.METHOD:
+            return RemoteMethod(self, name)
+        if kind == AttrKind.CONSTANT and name in self.__glass_consts:
+            return self.__glass_consts[name]
+
+        kind, value = ser.rpc.obj_lookup(self.__glass_obj_id, name)
+        kind = AttrKind(kind)
+        if kind != AttrKind.VALUE and self.__glass_cls is not None:
+            ser.attr_kinds[key] = kind
+        if kind == AttrKind.METHOD:
+            return RemoteMethod(self, name)
+        value = ser.deserialize(value)
+        if kind == AttrKind.CONSTANT:
+            self.__glass_consts[name] = value
+        return value
 
     def __call__(self, *args, **kwargs):
         args = tuple(self.__glass_ser.serialize(arg) for arg in args)
@@ -29,16 +256,20 @@ class NetworkObj:
         return self.__glass_ser.deserialize(ser)
 
     def __iter__(self):
-        ser = self.__glass_ser.rpc.obj_iter(self.__glass_obj_id)
-        return self.__glass_ser.deserialize(ser)
+        return iterate(self)
 
     def __next__(self):
-        ser = self.__glass_ser.rpc.obj_next(self.__glass_obj_id)
-        return self.__glass_ser.deserialize(ser)
+        items, _ = self.__glass_ser.rpc.obj_next_batch(self.__glass_obj_id, 1)
+        if not items:
+            raise StopIteration
+        return self.__glass_ser.deserialize(items[0])
 
     def __iadd__(self, other):
         other = self.__glass_ser.serialize(other)
         ser = self.__glass_ser.rpc.obj_iadd(self.__glass_obj_id, other)
+        if ser is None:
+            # added in place, nothing to rebind
+            return self
         return self.__glass_ser.deserialize(ser)
 
     def __getitem__(self, item):
@@ -49,15 +280,19 @@ class NetworkObj:
     def __setitem__(self, item, value):
         item = self.__glass_ser.serialize(item)
         value = self.__glass_ser.serialize(value)
-        ser = self.__glass_ser.rpc.obj_setitem(self.__glass_obj_id, item, value)
-        return self.__glass_ser.deserialize(ser)
+        self.__glass_ser.rpc.notify("obj_setitem", self.__glass_obj_id, item, value)
 
     def __del__(self):
+        # the reader thread is gone once the interpreter starts shutting down
+        if sys.is_finalizing():
+            return
+
         rpc = self.__glass_ser.rpc
         if not rpc.live():
             return
 
-        rpc.obj_del(self.__glass_obj_id)
+        # __del__ can run on any thread, including the reader, so never block here
+        self.__glass_ser.release_stub(self.__glass_obj_id)
 
 
 # class NetworkCell(types
@@ -65,7 +300,7 @@ class NetworkObj:
 
 def netobj_endpoints(srl: "Serializer", rpc):
     @rpc.endpoint
-    def add_obj(ser, to_global=False):
+    def add_obj(ser, to_global=False, cache=False, ttl=None):
         typ = ObjType(ser[0])
         if typ == ObjType.SIMPLE:
             raise Exception(
@@ -77,57 +312,126 @@ def netobj_endpoints(srl: "Serializer", rpc):
         obj = srl.deserialize(ser)
         if to_global:
             srl.module_globals[obj.__module__][obj.__name__] = obj
+        if cache:
+            # the stub is cached, calls by name from other remote code are not
+            obj = srl.memoize(obj, ser, ttl)
         return srl.serialize_ref(obj)
 
     @rpc.endpoint
     def obj_getattr(obj_id, name):
-        obj = srl.ref_objs[obj_id]
+        obj = srl.get_ref(obj_id)
         attr = getattr(obj, name)
         return srl.serialize(attr)
 
     @rpc.endpoint
     def obj_call(obj_id, args, kwargs):
-        obj = srl.ref_objs[obj_id]
+        obj = srl.get_ref(obj_id)
         args = tuple(srl.deserialize(arg) for arg in args)
         kwargs = {k: srl.deserialize(v) for k, v in kwargs.items()}
 
         ret = obj(*args, **kwargs)
         return srl.serialize(ret)
 
+    @rpc.endpoint
+    def obj_lookup(obj_id, name):
+        """
+        getattr() that tells the caller what it may cache: a method of the class
+        comes back as just that, without a bound method to reference.
+        """
+        obj = srl.get_ref(obj_id)
+        if class_method(obj, name) is not None:
+            return [AttrKind.METHOD.value, None]
+        value = getattr(obj, name)
+        if name in getattr(type(obj), "__glass_immutable__", ()):
+            return [AttrKind.CONSTANT.value, srl.serialize(value)]
+        return [AttrKind.VALUE.value, srl.serialize(value)]
+
+    @rpc.endpoint
+    def obj_call_method(obj_id, name, args, kwargs):
+        obj = srl.get_ref(obj_id)
+        args = tuple(srl.deserialize(arg) for arg in args)
+        kwargs = {k: srl.deserialize(v) for k, v in kwargs.items()}
+        func = class_method(obj, name)
+        if func is None:
+            raise StaleMethod(f"{type(obj).__name__}.{name} is no longer a method")
+        return srl.serialize(func(obj, *args, **kwargs))
+
+    @rpc.endpoint
+    def obj_eval(obj_id, ops):
+        obj = srl.get_ref(obj_id)
+        return srl.serialize(srl.evaluate(obj, ops))
+
     @rpc.endpoint
     def obj_iter(obj_id):
-        obj = srl.ref_objs[obj_id]
-        return srl.serialize(iter(obj))
+        obj = srl.get_ref(obj_id)
+        with srl.obj_lock(obj_id):
+            return srl.serialize(iter(obj))
 
     @rpc.endpoint
-    def obj_next(obj_id):
-        obj = srl.ref_objs[obj_id]
-        return srl.serialize(next(obj))
+    def obj_next_batch(obj_id, n):
+        """
+        Up to `n` items and whether the iterator is exhausted. An error after
+        some items is raised on the following call, so those items aren't lost.
+        """
+        obj = srl.get_ref(obj_id)
+        with srl.obj_lock(obj_id):
+            error = srl.iter_errors.pop(obj_id, None)
+            if error is not None:
+                raise error
+
+            items = []
+            try:
+                for item in itertools.islice(obj, n):
+                    items.append(srl.serialize(item))
+            except Exception as e:
+                if not items:
+                    raise
+                srl.iter_errors[obj_id] = e
+                return [items, False]
+            return [items, len(items) < n]
+
+    @rpc.endpoint
+    def map_chunk(func, items, star):
+        """
+        Apply `func` to every item, `[results, error]` where `error` is what
+        stopped it after `results`, if anything did.
+        """
+        func = srl.deserialize(func)
+        items = srl.deserialize(items)
+        results = []
+        try:
+            # extend() keeps what was appended before an error
+            results.extend(itertools.starmap(func, items) if star else map(func, items))
+        except Exception as e:
+            if not results:
+                raise
+            return [srl.serialize(results), pack_exception(e)]
+        return [srl.serialize(results), None]
 
     @rpc.endpoint
     def obj_iadd(obj_id, other):
         other = srl.deserialize(other)
-        obj = srl.ref_objs[obj_id]
-        obj += other
-        return srl.serialize(obj)
+        obj = srl.get_ref(obj_id)
+        with srl.obj_lock(obj_id):
+            ret = operator.iadd(obj, other)
+            # the caller keeps its stub when the object changed in place
+            return None if ret is obj else srl.serialize(ret)
 
     @rpc.endpoint
     def obj_getitem(obj_id, item):
-        obj = srl.ref_objs[obj_id]
+        obj = srl.get_ref(obj_id)
         item = srl.deserialize(item)
         return srl.serialize(obj[item])
 
     @rpc.endpoint
     def obj_setitem(obj_id, item, value):
-        obj = srl.ref_objs[obj_id]
+        obj = srl.get_ref(obj_id)
         item = srl.deserialize(item)
         value = srl.deserialize(value)
-        obj[item] = value
-        return srl.serialize(obj)
+        with srl.obj_lock(obj_id):
+            obj[item] = value
 
     @rpc.endpoint
-    def obj_del(obj_id):
-        if obj_id not in srl.ref_objs:
-            logger.debug(f"obj_del: {obj_id} not found")
-            return
-        del srl.ref_objs[obj_id]
+    def obj_release(obj_ids):
+        for obj_id in obj_ids:
+            srl.release_ref(obj_id)
@@ -0,0 +1,201 @@
+import pickle
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import Future
+from .client import Remote
+from .netobj import NetworkObj, stub_id
+from .util import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class RemotePool:
+    """
+    Connections to several glass servers, `per_host` to each. Every connection
+    is served by a process of its own, so a pool spreads work over the cores of
+    all the servers.
+
+        with RemotePool([("node1", 8000), ("node2", 8000)], per_host=8) as pool:
+            futures = [pool.submit(fit, params) for params in grid]
+            scores = list(pool.map(score, rows, chunksize=1000))
+
+    Functions are captured on a connection the first time they are sent there.
+    Calls go to the connection with the fewest calls in flight, except that a
+    call involving a remote object goes to the connection that owns it, and
+    remote objects returned by a call belong to the connection that made it.
+    """
+
+    def __init__(self, addresses, per_host=1, cache_size=1024, **options):
+        self.remotes = [
+            Remote(host, port, **options) for host, port in addresses for _ in range(per_host)
+        ]
+        # calls in flight per connection
+        self.load = [0] * len(self.remotes)
+        self.lock = threading.Lock()
+        # breaks ties between idle connections
+        self.turn = itertools.count()
+        # function -> its stub on each connection
+        self.stubs = LRUCache(cache_size)
+
+    def close(self):
+        for remote in self.remotes:
+            remote.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.remotes)
+
+    def owner(self, obj):
+        """
+        Index of the connection a stub belongs to, None for anything else.
+        """
+        if not isinstance(obj, NetworkObj):
+            return None
+        ser = obj.__dict__["_NetworkObj__glass_ser"]
+        for index, remote in enumerate(self.remotes):
+            if remote.ser is ser:
+                return index
+        raise ValueError("remote object from a connection outside this pool")
+
+    def route(self, func, args=(), kwargs=None):
+        """
+        The connection that owns any of the remote objects involved, or else
+        the least loaded one.
+        """
+        owners = {self.owner(obj) for obj in (func, *args, *(kwargs or {}).values())}
+        owners.discard(None)
+        if len(owners) > 1:
+            raise ValueError("remote objects from different connections in one call")
+        if owners:
+            return owners.pop()
+        with self.lock:
+            start = next(self.turn)
+            n = len(self.remotes)
+            return min(range(n), key=lambda i: (self.load[i], (i - start) % n))
+
+    def stub(self, func, index):
+        if isinstance(func, NetworkObj):
+            return func
+        stubs = self.stubs.get(func)
+        if stubs is None:
+            stubs = [None] * len(self.remotes)
+            self.stubs[func] = stubs
+        if stubs[index] is None:
+            # not capture(), nested functions and lambdas are fine here
+            remote = self.remotes[index]
+            stubs[index] = remote.ser.deserialize(remote.rpc.add_obj(remote.ser.serialize(func)))
+        return stubs[index]
+
+    def call(self, index, name, args, finish):
+        """
+        Send a call on connection `index`, the returned future gets
+        `finish(remote, reply)`. It runs on a worker of that connection, as
+        deserializing may need calls of its own.
+        """
+        remote = self.remotes[index]
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def complete(slot):
+            try:
+                future.set_result(finish(remote, remote.rpc.wait(slot)))
+            except BaseException as e:
+                future.set_exception(e)
+
+        def on_done(slot):
+            with self.lock:
+                self.load[index] -= 1
+            if remote.rpc.submit(complete, slot) is None:
+                future.set_exception(EOFError("connection closed"))
+
+        with self.lock:
+            self.load[index] += 1
+        try:
+            remote.rpc.begin(name, args, {}, on_done)
+        except BaseException:
+            with self.lock:
+                self.load[index] -= 1
+            raise
+        return future
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)` on the pool, returns a
+        `concurrent.futures.Future` for the result.
+        """
+        index = self.route(func, args, kwargs)
+        ser = self.remotes[index].ser
+        stub = self.stub(func, index)
+        args = tuple(ser.serialize(arg) for arg in args)
+        kwargs = {k: ser.serialize(v) for k, v in kwargs.items()}
+        return self.call(
+            index,
+            "obj_call",
+            (stub_id(stub), args, kwargs),
+            lambda remote, reply: remote.ser.deserialize(reply),
+        )
+
+    def submit_chunk(self, func, chunk, star):
+        index = self.route(func)
+        ser = self.remotes[index].ser
+        args = (ser.serialize(func), ser.serialize(chunk), star)
+        return self.call(index, "map_chunk", args, finish_chunk)
+
+    def map(self, func, iterable, chunksize=256, ordered=True, window=None):
+        """
+        `Remote.map()` over the whole pool, chunks go to whichever connection
+        is least loaded. `window` defaults to two chunks per connection.
+        """
+        return self.map_chunks(func, iterable, False, chunksize, ordered, window)
+
+    def starmap(self, func, iterable, chunksize=256, ordered=True, window=None):
+        return self.map_chunks(func, iterable, True, chunksize, ordered, window)
+
+    def map_chunks(self, func, iterable, star, chunksize, ordered, window):
+        if window is None:
+            window = 2 * len(self.remotes)
+        iterable = iter(iterable)
+        chunks = iter(lambda: list(itertools.islice(iterable, chunksize)), [])
+        in_flight = deque()
+        done = deque()
+        ready = threading.Condition()
+
+        def on_done(future):
+            with ready:
+                done.append(future)
+                ready.notify()
+
+        def send(chunk):
+            future = self.submit_chunk(func, chunk, star)
+            in_flight.append(future)
+            if not ordered:
+                future.add_done_callback(on_done)
+
+        for chunk in itertools.islice(chunks, window):
+            send(chunk)
+        while in_flight:
+            if ordered:
+                future = in_flight.popleft()
+            else:
+                with ready:
+                    ready.wait_for(lambda: done)
+                    future = done.popleft()
+                in_flight.remove(future)
+            results, error = future.result()
+            for chunk in itertools.islice(chunks, 1):
+                send(chunk)
+            yield from results
+            if error is not None:
+                raise error
+
+
+def finish_chunk(remote, reply):
+    results, error = reply
+    return remote.ser.deserialize(results), None if error is None else pickle.loads(error)
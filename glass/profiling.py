@@ -0,0 +1,179 @@
+"""
+Profiling of remote calls, see `Remote.profile()`.
+
+Calls made inside the context go through `profile_endpoint`, which runs the
+real endpoint under cProfile on the server and sends the stats back with the
+result. The client profiles itself over the same span, and the report puts the
+two side by side: where the time went on each end, and the server's hottest
+functions.
+
+The breakdown comes from cumulative times of the serializer and of waiting on
+the peer, so parts can overlap, e.g. a deserialization that fetches a global
+from the client counts in both. Since 3.12 a profiler sees every thread of its
+process, and only one can run at a time: a profiled call that finds the
+profiler busy runs without its own stats, its time shows up in the outer one.
+"""
+
+import io
+import time
+import pstats
+import marshal
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# (module, function) for each part of the breakdown
+PARTS = {
+    "serialize": ("glass/serdes.py", "serialize"),
+    "deserialize": ("glass/serdes.py", "deserialize"),
+    # blocked on calls to the peer: reverse fetches, callbacks on remote objects
+    "wait": ("glass/bidirpc.py", "wait"),
+}
+
+
+def start():
+    """
+    A running profiler, or None if another one is active in this process.
+    """
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        return None
+    return prof
+
+
+def stop(prof):
+    prof.disable()
+    prof.create_stats()
+    return prof.stats
+
+
+def run(endpoint, args, kwargs):
+    """
+    `endpoint(*args, **kwargs)` under the profiler, `[result, stats, seconds]`
+    with the stats marshalled, or None if they couldn't be taken.
+    """
+    prof = start()
+    started = time.perf_counter()
+    try:
+        resp = endpoint(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats = None if prof is None else stop(prof)
+    return [resp, None if stats is None else marshal.dumps(stats), elapsed]
+
+
+class Loaded:
+    """
+    Stats from elsewhere, in the shape `pstats.Stats` loads from a profiler.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def breakdown(stats, total):
+    """
+    Seconds per part of `PARTS` in raw profiler stats, plus the rest of `total`.
+    """
+    parts = dict.fromkeys(PARTS, 0.0)
+    for (filename, _, name), (_, _, _, cumulative, _) in stats.items():
+        for part, (module, func) in PARTS.items():
+            if name == func and filename.endswith(module):
+                parts[part] += cumulative
+    parts["other"] = max(0.0, total - sum(parts.values()))
+    parts["total"] = total
+    return parts
+
+
+class ProfileReport:
+    """
+    Client and server profile of the calls made in a `Remote.profile()` block.
+
+    `calls` lists every profiled call as (endpoint, round trip, time in the
+    server), `client` and `server` are `pstats.Stats`, or None when there are
+    no stats for that side.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.client = None
+        self.server = None
+        self.client_parts = None
+        self.server_parts = dict.fromkeys([*PARTS, "other", "total"], 0.0)
+        self.wall = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, name, data, seconds, round_trip):
+        """
+        Stats of one call, as sent back by `run()`. Called on the reader thread.
+        """
+        with self.lock:
+            self.calls.append((name, round_trip, seconds))
+            if data is None:
+                self.server_parts["other"] += seconds
+                self.server_parts["total"] += seconds
+                return
+            stats = marshal.loads(data)
+            for part, value in breakdown(stats, seconds).items():
+                self.server_parts[part] += value
+            if self.server is None:
+                self.server = pstats.Stats(Loaded(stats))
+            else:
+                self.server.add(pstats.Stats(Loaded(stats)))
+
+    @contextmanager
+    def collect(self, rpc):
+        """
+        Profile the calls this thread makes on `rpc` for the duration.
+        """
+        outer = getattr(rpc.context, "profile", None)
+        rpc.context.profile = self
+        prof = start()
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.wall = time.perf_counter() - started
+            rpc.context.profile = outer
+            if prof is not None:
+                stats = stop(prof)
+                self.client_parts = breakdown(stats, self.wall)
+                self.client = pstats.Stats(Loaded(stats))
+
+    def summary(self):
+        """
+        The breakdown as plain data, in seconds.
+        """
+        return {
+            "wall": self.wall,
+            "calls": len(self.calls),
+            "round_trips": sum(rt for _, rt, _ in self.calls),
+            "client": self.client_parts,
+            "server": self.server_parts,
+        }
+
+    def print_stats(self, side="server", sort="cumulative", limit=20):
+        stats = getattr(self, side)
+        if stats is not None:
+            stats.sort_stats(sort).print_stats(limit)
+
+    def __str__(self):
+        out = io.StringIO()
+        print(f"{len(self.calls)} remote calls in {self.wall * 1e3:.1f} ms", file=out)
+        print(f"{'':12}{'client ms':>12}{'server ms':>12}", file=out)
+        for part in [*PARTS, "other", "total"]:
+            client = "-" if self.client_parts is None else f"{self.client_parts[part] * 1e3:.2f}"
+            print(f"{part:12}{client:>12}{self.server_parts[part] * 1e3:>12.2f}", file=out)
+        if self.server is not None:
+            print("\nserver, by cumulative time:", file=out)
+            stream, self.server.stream = self.server.stream, out
+            try:
+                self.server.sort_stats("cumulative").print_stats(15)
+            finally:
+                self.server.stream = stream
+        return out.getvalue()
@@ -1,47 +1,343 @@
 import re
 import sys
+import dis
 import types
+import builtins
 import inspect
+import operator
+import array
 import marshal
+import pickle
+import decimal
+import datetime
+import fractions
+import pathlib
+import uuid
+import dataclasses
+import hashlib
 import importlib
 import logging
-from .types import ObjType
-from .netobj import NetworkObj, netobj_endpoints
+import time
+import threading
+import weakref
+from collections import OrderedDict
+import msgpack
+from .types import ObjType, ExtCode, OpType
+from .util import LRUCache
+from .netobj import NetworkObj, Promise, RemoteMethod, netobj_endpoints, promise_parts, stub_id
+from .netobj import VALUE_ENDPOINTS
+from .bidirpc import OOB_THRESHOLD, OutOfBand, pack_default, unpack_packed
+from .memo import MemoCache, Memoized
 
 # Get logger for this module
 logger = logging.getLogger(__name__)
 
 
-def is_simple(obj):
-    import msgpack
+SCALARS = (type(None), bool, float, str, bytes)
+CONTAINERS = (list, tuple, dict)
 
-    try:
-        msgpack.packb(obj)
-        return True
-    except Exception:
-        return False
+
+def pack_simple(obj):
+    """
+    Wire form of `obj` if it is made only of msgpack-native values, else None.
+
+    Scalars are recognised by type and sent as-is. Containers are packed once
+    here and travel as a PACKED ext that the peer's unpacker decodes in place,
+    so the frame never encodes them a second time.
+    """
+    typ = type(obj)
+    if typ in SCALARS:
+        return obj
+    if isinstance(obj, int):
+        if -(2**63) <= obj < 2**64:
+            return obj
+        return None
+    if isinstance(obj, CONTAINERS):
+        try:
+            return msgpack.ExtType(ExtCode.PACKED.value, msgpack.packb(obj))
+        except (TypeError, ValueError, OverflowError):
+            return None
+    if isinstance(obj, SCALARS):
+        # subclasses such as str enums, msgpack packs them as their base type
+        return obj
+    return None
+
+
+# containers copied member by member when they aren't simple as a whole
+COPY_CONTAINERS = {list: "list", tuple: "tuple", set: "set", frozenset: "frozenset", dict: "dict"}
+CONTAINER_TYPES = {v: k for k, v in COPY_CONTAINERS.items()}
+
+# stdlib value types that are copied by pickling
+PICKLED_TYPES = (
+    datetime.date,
+    datetime.time,
+    datetime.timedelta,
+    datetime.timezone,
+    decimal.Decimal,
+    fractions.Fraction,
+    uuid.UUID,
+    pathlib.PurePath,
+    complex,
+)
+
+
+def serialize_buffer(obj):
+    """
+    [BUFFER, kind, meta, data] for large bytes and for bytearrays, memoryviews,
+    arrays and NumPy arrays, whose memory goes on the wire as-is. None for
+    anything else.
+    """
+    typ = type(obj)
+    if typ is bytes:
+        if len(obj) < OOB_THRESHOLD:
+            return None
+        kind, meta, view = "bytes", None, memoryview(obj)
+    elif typ is bytearray:
+        kind, meta, view = "bytearray", None, memoryview(obj)
+    elif typ is memoryview:
+        view = obj if obj.c_contiguous else memoryview(obj.tobytes())
+        kind, meta = "memoryview", [obj.format, list(obj.shape)]
+    elif typ is array.array:
+        kind, meta, view = "array", obj.typecode, memoryview(obj)
+    else:
+        np = sys.modules.get("numpy")
+        if np is None or typ is not np.ndarray or obj.dtype.hasobject:
+            return None
+        # no copy unless the array is strided
+        arr = np.ascontiguousarray(obj)
+        dtype = arr.dtype.descr if arr.dtype.fields else arr.dtype.str
+        kind, meta, view = "ndarray", [dtype, list(arr.shape)], memoryview(arr.reshape(-1))
+
+    logger.debug(f"serialize: buffer {kind} of {view.nbytes} bytes")
+    return [ObjType.BUFFER.value, kind, meta, OutOfBand(view.cast("B"))]
+
+
+def deserialize_buffer(kind, meta, data):
+    if type(data) is OutOfBand:
+        # never went through a socket
+        data = data.view
+    if kind == "packed":
+        return unpack_packed(data)
+    if kind == "bytes":
+        return bytes(data)
+    if kind == "bytearray":
+        return data if type(data) is bytearray else bytearray(data)
+    if type(data) is bytes:
+        # small enough to travel inline, copy so the result is writable
+        data = bytearray(data)
+
+    if kind == "memoryview":
+        fmt, shape = meta
+        return memoryview(data).cast(fmt, shape)
+    if kind == "array":
+        out = array.array(meta)
+        out.frombytes(data)
+        return out
+    if kind == "ndarray":
+        np = importlib.import_module("numpy")
+        dtype, shape = meta
+        if isinstance(dtype, list):
+            dtype = [tuple(field) for field in dtype]
+        # a view on the receive buffer, not a copy
+        return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape)
+    raise Exception(f"unknown buffer kind {kind}")
+
+
+class BackRef(msgpack.ExtType):
+    """
+    Wire form of a stub sent back to the peer that owns the object. It holds the
+    stub until the frame is sent, so the stub's release can't overtake it.
+    """
+
+    def __new__(cls, stub):
+        self = super().__new__(cls, ExtCode.BACKREF.value, msgpack.packb(stub_id(stub)))
+        self.stub = stub
+        return self
+
+
+class CircularReference(Exception):
+    """
+    `obj` contains itself, found while serializing its members.
+    """
+
+    def __init__(self, obj, context):
+        super().__init__(f"circular reference {context} -> {obj}")
+        self.obj = obj
+
+
+class MissingRef:
+    __slots__ = ("obj_id",)
+
+    def __init__(self, obj_id):
+        self.obj_id = obj_id
+
+
+class ByRef:
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+
+def byref(obj):
+    """
+    Pass `obj` by reference even where it would be copied, e.g. a list the
+    remote side should mutate in place.
+    """
+    return ByRef(obj)
+
+
+def same_key(a, b):
+    """
+    Whether two keys from `Serializer.func_key` or `cls_key` match: the same
+    objects, compared by identity, and the same ids.
+    """
+    objs, ids = a
+    return len(objs) == len(b[0]) and all(map(operator.is_, objs, b[0])) and ids == b[1]
+
+
+def global_names(code):
+    """
+    Names `code` and the code objects nested in it look up as globals.
+    """
+    names = set()
+    for ins in dis.get_instructions(code):
+        if ins.opname in ("LOAD_GLOBAL", "LOAD_NAME"):
+            names.add(ins.argval)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= global_names(const)
+    return names
 
 
 class FunctionDict(dict):
     def __init__(self, missing_func):
         self.missing_func = missing_func
+        # concurrent misses on the same key would fetch it twice
+        self.lock = threading.RLock()
 
     def __missing__(self, key):
-        ret = self.missing_func(key)
-        if ret is None:
-            super().__missing__(key)
-        self[key] = ret
-        return ret
+        with self.lock:
+            if key in self:
+                return self[key]
+            ret = self.missing_func(key)
+            if ret is None:
+                super().__missing__(key)
+            self[key] = ret
+            return ret
 
 
 class Serializer:
-    def __init__(self, rpc):
+    """
+    Functions without closures and classes are content addressed: the first time
+    one is sent the payload carries its digest, after that only
+    `[CACHED, digest]` goes over the wire. The receiver keeps what it rebuilt
+    under the digest and asks the sender for the payload again on a miss.
+
+    With `eager_globals`, a function carries the globals its code uses, so the
+    receiver doesn't fetch them one round trip at a time. They are taken when
+    the function is first sent, names that aren't defined yet are still fetched
+    on first use.
+
+    Objects passed by reference stay in `ref_objs` until every stub the peer got
+    for them is released. `max_refs` caps the table, evicting the least recently
+    used, and `ref_ttl` expires references unused for that many seconds, for
+    peers that hold on to stubs. Using an evicted reference raises KeyError.
+
+    Functions captured with `cache` are wrapped in `Memoized`, with their
+    results kept in `memo`, a `MemoCache` of this connection's own unless one
+    shared with others is passed.
+
+    With `copy_values`, containers, dataclass instances and stdlib value types
+    are copied even when they hold members that aren't msgpack-native, and only
+    those members that can't be copied go by reference. `byref` opts out.
+    """
+
+    def __init__(
+        self,
+        rpc,
+        netobj=NetworkObj,
+        cache_size=1024,
+        copy_values=True,
+        eager_globals=True,
+        prefetch=256,
+        readahead=False,
+        max_refs=None,
+        ref_ttl=None,
+        memo=None,
+    ):
         logger.debug("initializing serializer")
-        self.rpc = rpc
+        # stub class for references received from the peer
+        self.netobj = netobj
+        self.copy_values = copy_values
+        self.eager_globals = eager_globals
+        # remote iteration: largest batch per round trip, and whether to read ahead
+        self.prefetch = prefetch
+        self.readahead = readahead
         self.ref_objs = {}
+        # one count per REF handed out, the peer releases each stub separately
+        self.ref_counts = {}
+        self.ref_locks = {}
+        # obj_id -> last use, least recently used first
+        self.ref_used = OrderedDict()
+        self.max_refs = max_refs
+        self.ref_ttl = ref_ttl
+        self.memo = MemoCache() if memo is None else memo
+        self.ref_events = {"released": 0, "expired": 0, "evicted": 0}
+        # error raised by an iterator after part of a batch, raised on the next one
+        self.iter_errors = {}
+        self.ref_lock = threading.Lock()
+        # ids of dropped stubs, released in one one-way message
+        self.releases = []
+        self.release_lock = threading.Lock()
+        # per-thread, calls on one connection may deserialize concurrently
+        self.local = threading.local()
         self.module_globals = FunctionDict(lambda mod: self.new_mod_globals(mod))
+        # code object -> marshalled bytes, on the sending side
+        self.code_sent = LRUCache(cache_size)
+        # code object -> sorted names of the globals it uses
+        self.code_globals = LRUCache(cache_size)
+        # marshalled bytes -> code object, on the receiving side
+        self.code_objs = LRUCache(cache_size)
+        # digest -> payload we sent, so the peer can fetch it again on a miss
+        self.shipped = LRUCache(cache_size)
+        # digest -> function or class rebuilt from a payload we received
+        self.rebuilt = LRUCache(cache_size)
+        # digest -> the function or class we shipped under it
+        self.originals = LRUCache(cache_size)
+        # (remote class id, name) -> AttrKind, for attributes stubs may cache
+        self.attr_kinds = LRUCache(cache_size)
+        # rebuilt function or class -> its digest, sending it back needs no payload
+        self.digests = weakref.WeakKeyDictionary()
+        # function or class we shipped -> (what its payload was built from, digest)
+        self.sent_digests = weakref.WeakKeyDictionary()
+        self.attach(rpc)
+
+    def attach(self, rpc):
+        """
+        Serve and make calls on `rpc`, the connection to the peer. A session
+        moves its serializer to every connection the client comes back on.
+        """
+        self.rpc = rpc
+        rpc.ext_hooks[ExtCode.BACKREF.value] = self.resolve_backref
+        rpc.on_dropped = self.drop_result
         netobj_endpoints(self, rpc)
 
+        @rpc.endpoint
+        def get_cached_endpoint(digest):
+            payload = self.shipped.get(digest)
+            if payload is None:
+                raise KeyError(f"payload {digest.hex()} no longer cached")
+            return payload
+
+        @rpc.endpoint
+        def ref_stats_endpoint():
+            return self.ref_stats()
+
+        @rpc.endpoint
+        def memo_stats_endpoint():
+            return self.memo.stats()
+
         @rpc.endpoint
         def get_global_endpoint(mod, name):
             assert mod == "__main__"
@@ -50,6 +346,137 @@ class Serializer:
 
             return self.serialize(obj)
 
+    def obj_lock(self, obj_id):
+        """
+        Lock for a referenced object, held by endpoints that mutate or advance it
+        since calls on one connection run concurrently.
+        """
+        with self.ref_lock:
+            lock = self.ref_locks.get(obj_id)
+            if lock is None:
+                lock = self.ref_locks[obj_id] = threading.RLock()
+            return lock
+
+    def release_ref(self, obj_id):
+        with self.ref_lock:
+            count = self.ref_counts.get(obj_id)
+            if count is None:
+                logger.debug(f"release_ref: {obj_id} not found")
+                return
+            if count > 1:
+                self.ref_counts[obj_id] = count - 1
+                return
+            self.drop_ref(obj_id)
+            self.ref_events["released"] += 1
+
+    def get_ref(self, obj_id):
+        """
+        Object behind a reference we handed out, for the endpoints.
+        """
+        with self.ref_lock:
+            self.trim_refs()
+            obj = self.ref_objs.get(obj_id)
+            if obj is None:
+                raise KeyError(f"object {obj_id} was released or expired")
+            self.touch_ref(obj_id)
+            return obj
+
+    def touch_ref(self, obj_id):
+        self.ref_used[obj_id] = time.monotonic()
+        self.ref_used.move_to_end(obj_id)
+
+    def drop_ref(self, obj_id):
+        del self.ref_counts[obj_id]
+        del self.ref_objs[obj_id]
+        del self.ref_used[obj_id]
+        self.ref_locks.pop(obj_id, None)
+        self.iter_errors.pop(obj_id, None)
+
+    def trim_refs(self):
+        """
+        Expire and evict references past `ref_ttl` and `max_refs`, under `ref_lock`.
+        """
+        if self.ref_ttl is not None:
+            deadline = time.monotonic() - self.ref_ttl
+            while self.ref_used:
+                obj_id, used = next(iter(self.ref_used.items()))
+                if used > deadline:
+                    break
+                logger.debug(f"expiring ref {obj_id}")
+                self.drop_ref(obj_id)
+                self.ref_events["expired"] += 1
+        if self.max_refs is not None:
+            while len(self.ref_objs) > self.max_refs:
+                obj_id = next(iter(self.ref_used))
+                logger.debug(f"evicting ref {obj_id}")
+                self.drop_ref(obj_id)
+                self.ref_events["evicted"] += 1
+
+    def ref_stats(self):
+        """
+        Live references and the stubs the peer holds for them, the shallow size
+        of the objects they keep alive, and how many went away and why.
+        """
+        with self.ref_lock:
+            self.trim_refs()
+            objs = list(self.ref_objs.values())
+            stats = {"live_refs": len(objs), "stubs": sum(self.ref_counts.values())}
+            stats.update(self.ref_events)
+        stats["bytes_held"] = sum(sys.getsizeof(obj, 0) for obj in objs)
+        return stats
+
+    def memoize(self, func, ser, ttl=None):
+        """
+        `func`, rebuilt from `ser`, with its results cached under its content
+        digest, shared by every client that sends the same function.
+        """
+        if not isinstance(func, types.FunctionType):
+            raise TypeError(f"only functions can be cached, not {type(func).__name__}")
+        digest = self.digests.get(func)
+        if digest is None:
+            # closures aren't content addressed, their payload stands in
+            try:
+                packed = msgpack.packb(ser, default=lambda obj: pack_default(obj, None))
+                digest = hashlib.blake2b(packed, digest_size=16).digest()
+            except TypeError:
+                raise TypeError(f"{func.__qualname__} closes over remote objects, can't be cached")
+        return Memoized(func, digest, self.memo, ttl)
+
+    def drop_result(self, name, value):
+        """
+        Release what the peer handed out in a reply we gave up on: the stubs it
+        deserializes to are dropped right away.
+        """
+        if name in VALUE_ENDPOINTS:
+            self.deserialize(value)
+
+    def release_stub(self, obj_id):
+        """
+        Queue the release of a dropped stub. The first one schedules a flush,
+        those dropped before it runs go along with it.
+        """
+        with self.release_lock:
+            self.releases.append(obj_id)
+            if len(self.releases) > 1:
+                return
+        self.rpc.submit(self.flush_releases)
+
+    def flush_releases(self):
+        with self.release_lock:
+            obj_ids, self.releases = self.releases, []
+        if obj_ids and self.rpc.live():
+            self.rpc.notify("obj_release", obj_ids)
+
+    def resolve_backref(self, data):
+        # runs on the reader, a stub released right after this frame can't free it first
+        obj_id = msgpack.unpackb(data)
+        with self.ref_lock:
+            obj = self.ref_objs.get(obj_id)
+            if obj is None:
+                return MissingRef(obj_id)
+            self.touch_ref(obj_id)
+            return obj
+
     def new_mod_globals(self, mod):
         logger.debug(f"creating new module globals: {mod}")
         out = FunctionDict(lambda name: self.get_global(mod, name))
@@ -66,14 +493,56 @@ class Serializer:
         return self.deserialize(ser)
 
     def serialize(self, obj, context=[]):
-        if obj in context:
-            # circular reference
-            raise Exception(f"circular reference {context} -> {obj}")
+        if any(obj is c for c in context):
+            raise CircularReference(obj, context)
+
+        buffer = serialize_buffer(obj)
+        if buffer is not None:
+            return buffer
 
         # if it's a trivially serializable, just send it
-        if is_simple(obj):
+        simple = pack_simple(obj)
+        if (
+            type(simple) is msgpack.ExtType
+            and len(simple.data) >= OOB_THRESHOLD
+            and self.rpc.codec is None
+        ):
+            # a large container, sent next to the frame rather than copied into
+            # it, unless the frame is compressed: buffers go out as they are
+            view = memoryview(simple.data)
+            return [ObjType.BUFFER.value, "packed", None, OutOfBand(view)]
+        if simple is not None or obj is None:
             logger.debug(f"serialize: simple object {type(obj).__name__}")
-            return [ObjType.SIMPLE.value, obj]
+            return [ObjType.SIMPLE.value, simple]
+
+        if type(obj) is ByRef:
+            return self.serialize_ref(obj.obj)
+
+        if isinstance(obj, self.netobj):
+            # a stub for one of the peer's objects, it resolves to the original there
+            return [ObjType.BACKREF.value, BackRef(obj)]
+
+        if type(obj) is Promise:
+            stub, ops = promise_parts(obj)
+            return [ObjType.PROMISE.value, BackRef(stub), self.serialize_ops(ops, context)]
+
+        if type(obj) is RemoteMethod:
+            # bound again where the object lives
+            ops = [[OpType.GETATTR.value, obj.name]]
+            return [ObjType.PROMISE.value, BackRef(obj.obj), ops]
+
+        if self.copy_values:
+            try:
+                copied, refs = self.taking_refs(lambda: self.serialize_value(obj, context))
+                self.keep_refs(refs)
+            except CircularReference as e:
+                if e.obj is not obj:
+                    raise
+                # a copy can't contain itself, the original can
+                logger.debug(f"serialize: {type(obj).__name__} contains itself, by reference")
+                copied = self.serialize_ref(obj)
+            if copied is not None:
+                return copied
 
         if isinstance(obj, types.CellType):
             logger.debug(f"serialize: cell {obj}")
@@ -94,58 +563,280 @@ class Serializer:
         except AttributeError:
             pass
 
+        if isinstance(obj, (types.FunctionType, type)):
+            digest = self.digests.get(obj)
+            if digest is not None:
+                logger.debug(f"serialize: back to origin {digest.hex()}")
+                return [ObjType.CACHED.value, digest]
+
         # if it's a function, send the code
         if isinstance(obj, types.FunctionType):
             logger.debug(f"serialize: function {obj.__module__}.{obj.__qualname__}")
-            code_ser = marshal.dumps(obj.__code__)
-            argdefs_ser = self.serialize(obj.__defaults__, context + [obj])
-            kwdefs_ser = self.serialize(obj.__kwdefaults__, context + [obj])
-            if obj.__closure__ is None:
-                closure_ser = None
-            else:
-                closure_ser = tuple(self.serialize(c, context + [obj]) for c in obj.__closure__)
-            return [
-                ObjType.FUNC.value,
-                obj.__module__,
-                obj.__name__,
-                argdefs_ser,
-                kwdefs_ser,
-                code_ser,
-                closure_ser,
-            ]
+            if obj.__closure__ is not None:
+                # cells are rebuilt on every call, so the function can't be shared
+                return self.serialize_func(obj, context) + [None]
+            return self.ship(obj, self.func_key(obj), lambda: self.serialize_func(obj, context))
 
         if isinstance(obj, type):
-            context = context + [obj]
-            name = obj.__name__
-            bases = obj.__bases__
-            bases_ser = tuple(self.serialize(b, context) for b in bases)
-
-            dict_exclude = {"__dict__", "__weakref__", "__doc__"}
-            objdict = obj.__dict__
-            dict_ser = {
-                k: self.serialize(v, context) for k, v in objdict.items() if k not in dict_exclude
-            }
-            return [ObjType.CLS.value, id(obj), name, bases_ser, dict_ser]
+            return self.ship(obj, self.cls_key(obj), lambda: self.serialize_cls(obj, context))
 
         # otherwise, send a reference
         logger.debug(f"serialize: reference {type(obj).__name__}")
         return self.serialize_ref(obj)
 
+    def serialize_value(self, obj, context):
+        """
+        Copy of `obj` with its members serialized one by one, or None if it
+        isn't a value type.
+        """
+        kind = COPY_CONTAINERS.get(type(obj))
+        if kind is not None:
+            logger.debug(f"serialize: copy {kind} of {len(obj)}")
+            context = context + [obj]
+            outermost = getattr(self.local, "classes", None) is None
+            if outermost:
+                self.local.classes = {}
+            try:
+                if kind == "dict":
+                    items = [
+                        [self.serialize(k, context), self.serialize(v, context)]
+                        for k, v in obj.items()
+                    ]
+                else:
+                    items = [self.serialize(v, context) for v in obj]
+            finally:
+                if outermost:
+                    self.local.classes = None
+            return [ObjType.CONTAINER.value, kind, items]
+
+        if isinstance(obj, PICKLED_TYPES):
+            return [ObjType.PICKLED.value, pickle.dumps(obj)]
+
+        if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+            logger.debug(f"serialize: copy dataclass {type(obj).__name__}")
+            context = context + [obj]
+            if hasattr(obj, "__dict__"):
+                # a shipped dataclass only has stubs for its Field objects, so
+                # fields() finds nothing on the remote side
+                state = vars(obj)
+            else:
+                state = {f.name: getattr(obj, f.name) for f in dataclasses.fields(obj)}
+            fields = {k: self.serialize(v, context) for k, v in state.items()}
+            return [ObjType.DATACLASS.value, self.serialize_class_of(obj, context), fields]
+
+        return None
+
+    def serialize_class_of(self, obj, context):
+        """
+        The class of a dataclass instance, serialized once per container: the
+        instances after the first get its digest.
+        """
+        cls = type(obj)
+        classes = getattr(self.local, "classes", None)
+        if classes is not None and cls in classes:
+            return classes[cls]
+        cls_ser = self.serialize(cls, context)
+        if classes is not None:
+            if cls_ser[0] == ObjType.CLS.value:
+                # rebuilt by the time the next instance is read
+                classes[cls] = [ObjType.CACHED.value, cls_ser[-1]]
+            else:
+                classes[cls] = cls_ser
+        return cls_ser
+
+    def serialize_globals(self, func, context):
+        """
+        {name: serialized value} for the globals `func` uses that are defined.
+        """
+        if not self.eager_globals:
+            return None
+        names = self.code_globals.get(func.__code__)
+        if names is None:
+            names = self.code_globals[func.__code__] = sorted(global_names(func.__code__))
+
+        out = {}
+        for name in names:
+            # the receiver resolves builtins itself
+            if name.startswith("__") or name in builtins.__dict__:
+                continue
+            if name not in func.__globals__:
+                # not defined yet, fetched on first use
+                continue
+            value = func.__globals__[name]
+            if any(value is c for c in context):
+                # recursion, the receiver fetches it once it has it
+                continue
+            try:
+                out[name], refs = self.taking_refs(lambda: self.serialize(value, context))
+                self.keep_refs(refs)
+            except Exception as e:
+                logger.debug(f"serialize: leaving global {name} to be fetched ({e})")
+        return out
+
+    def serialize_ops(self, ops, context):
+        out = []
+        for op in ops:
+            kind = op[0]
+            if kind == OpType.GETATTR:
+                out.append([kind.value, op[1]])
+            elif kind == OpType.CALL:
+                args = [self.serialize(arg, context) for arg in op[1]]
+                kwargs = {k: self.serialize(v, context) for k, v in op[2].items()}
+                out.append([kind.value, args, kwargs])
+            else:
+                out.append([kind.value, self.serialize(op[1], context)])
+        return out
+
+    def evaluate(self, obj, ops):
+        """
+        Apply the operations of a `Promise` to `obj`.
+        """
+        for op in ops:
+            kind = OpType(op[0])
+            if kind == OpType.GETATTR:
+                obj = getattr(obj, op[1])
+            elif kind == OpType.CALL:
+                args = tuple(self.deserialize(arg) for arg in op[1])
+                kwargs = {k: self.deserialize(v) for k, v in op[2].items()}
+                obj = obj(*args, **kwargs)
+            else:
+                obj = obj[self.deserialize(op[1])]
+        return obj
+
+    def serialize_func(self, obj, context):
+        context = context + [obj]
+        code_ser = self.code_sent.get(obj.__code__)
+        if code_ser is None:
+            code_ser = self.code_sent[obj.__code__] = marshal.dumps(obj.__code__)
+        argdefs_ser = self.serialize(obj.__defaults__, context)
+        kwdefs_ser = self.serialize(obj.__kwdefaults__, context)
+        if obj.__closure__ is None:
+            closure_ser = None
+        else:
+            closure_ser = tuple(self.serialize(c, context) for c in obj.__closure__)
+        globals_ser = self.serialize_globals(obj, context)
+        return [
+            ObjType.FUNC.value,
+            obj.__module__,
+            obj.__name__,
+            argdefs_ser,
+            kwdefs_ser,
+            code_ser,
+            closure_ser,
+            globals_ser,
+        ]
+
+    def serialize_cls(self, obj, context):
+        context = context + [obj]
+        name = obj.__name__
+        bases = obj.__bases__
+        bases_ser = tuple(self.serialize(b, context) for b in bases)
+
+        dict_exclude = {"__dict__", "__weakref__", "__doc__"}
+        objdict = obj.__dict__
+        dict_ser = {
+            k: self.serialize(v, context) for k, v in objdict.items() if k not in dict_exclude
+        }
+        return [ObjType.CLS.value, id(obj), name, bases_ser, dict_ser]
+
+    def func_key(self, func):
+        """
+        What the payload of `func` is built from, so a function is only
+        serialized again when its code, defaults or globals changed.
+        """
+        objs = (func.__code__, func.__defaults__, func.__kwdefaults__)
+        if not self.eager_globals:
+            return objs, ()
+        names = self.code_globals.get(func.__code__)
+        if names is None:
+            names = self.code_globals[func.__code__] = sorted(global_names(func.__code__))
+        glob = func.__globals__
+        # ids, the values would be kept alive along with the function
+        return objs, tuple(id(glob[name]) if name in glob else None for name in names)
+
+    def cls_key(self, cls):
+        return cls.__bases__, tuple((k, id(v)) for k, v in cls.__dict__.items())
+
+    def ship(self, obj, key, build):
+        """
+        Content address the FUNC or CLS payload `build()` returns, sending only
+        its digest once the peer has seen it. Its digest is kept with `key`, and
+        `obj` isn't serialized again while that stays the same.
+        """
+        sent = self.sent_digests.get(obj)
+        if sent is not None and same_key(sent[0], key) and self.shipped.get(sent[1]) is not None:
+            logger.debug(f"serialize: cached {sent[1].hex()}")
+            return [ObjType.CACHED.value, sent[1]]
+        payload, refs = self.taking_refs(build)
+        packed = msgpack.packb(payload, default=lambda obj: pack_default(obj, None))
+        digest = hashlib.blake2b(packed, digest_size=16).digest()
+        self.sent_digests[obj] = (key, digest)
+        if self.shipped.get(digest) is not None:
+            logger.debug(f"serialize: cached {digest.hex()}")
+            # the peer gets no stubs for what the payload references
+            self.release_refs(refs)
+            return [ObjType.CACHED.value, digest]
+        self.keep_refs(refs)
+        payload = self.shipped[digest] = payload + [digest]
+        self.originals[digest] = obj
+        return payload
+
     def serialize_ref(self, obj):
         obj_id = id(obj)
         logger.debug(f"serialize_ref: {type(obj).__name__} id={obj_id}")
-        self.ref_objs[obj_id] = obj
-        return [ObjType.REF.value, obj_id]
+        with self.ref_lock:
+            self.ref_objs[obj_id] = obj
+            self.ref_counts[obj_id] = self.ref_counts.get(obj_id, 0) + 1
+            self.touch_ref(obj_id)
+            self.trim_refs()
+        taken = getattr(self.local, "refs_taken", None)
+        if taken is not None:
+            taken.append(obj_id)
+        return [ObjType.REF.value, obj_id, id(type(obj))]
+
+    def taking_refs(self, build):
+        """
+        `build()`, serializing something that may not be sent after all, and
+        the references it handed out: the caller passes them on to `keep_refs`
+        if it's sent and to `release_refs` if not. They are released if it raises.
+        """
+        outer = getattr(self.local, "refs_taken", None)
+        self.local.refs_taken = refs = []
+        try:
+            return build(), refs
+        except BaseException:
+            self.release_refs(refs)
+            raise
+        finally:
+            self.local.refs_taken = outer
+
+    def keep_refs(self, refs):
+        """
+        Hand `refs` over to whatever is being built around them, if anything.
+        """
+        taken = getattr(self.local, "refs_taken", None)
+        if taken is not None:
+            taken.extend(refs)
+
+    def release_refs(self, refs):
+        for obj_id in refs:
+            self.release_ref(obj_id)
 
     def deserialize(self, ser):
         typ = ObjType(ser[0])
         if typ == ObjType.SIMPLE:
             logger.debug(f"deserialize: {typ}")
-            return ser[1]
+            value = ser[1]
+            if isinstance(value, msgpack.ExtType):
+                # not through a socket, so nobody unpacked it yet
+                return self.rpc.ext_hooks(value.code, value.data)
+            return value
         elif typ == ObjType.FUNC:
-            mod, name, argdefs_ser, kwdefs_ser, code_ser, closure_ser = ser[1:]
+            mod, name, argdefs_ser, kwdefs_ser, code_ser, closure_ser, globals_ser, digest = ser[1:]
             logger.debug(f"deserialize: {typ} {mod}.{name}")
-            code = marshal.loads(code_ser)
+            code = self.code_objs.get(code_ser)
+            if code is None:
+                code = self.code_objs[code_ser] = marshal.loads(code_ser)
             if closure_ser is None:
                 closure = None
             else:
@@ -154,30 +845,76 @@ class Serializer:
             if argdefs is not None:
                 argdefs = tuple(argdefs)
             kwargdefs = self.deserialize(kwdefs_ser)
-            func = types.FunctionType(
-                code, self.module_globals[mod], name, argdefs, closure, kwargdefs
-            )
+            mod_globals = self.module_globals[mod]
+            if globals_ser:
+                for key, value in globals_ser.items():
+                    # a name that's already there may have been reassigned remotely
+                    if key not in mod_globals:
+                        mod_globals.setdefault(key, self.deserialize(value))
+            func = types.FunctionType(code, mod_globals, name, argdefs, closure, kwargdefs)
+            if digest is not None:
+                self.rebuilt[digest] = func
+                self.digests[func] = digest
             return func
         elif typ == ObjType.CLS:
-            old_id, name, bases_ser, dict_ser = ser[1:]
-            self.placeholders = {}
+            old_id, name, bases_ser, dict_ser, digest = ser[1:]
+            self.local.placeholders = {}
             logger.debug(f"deserialize: {typ} {name}")
             bases = tuple(self.deserialize(b) for b in bases_ser)
             objdict = {k: self.deserialize(v) for k, v in dict_ser.items()}
             cls = type(name, bases, objdict)
-            if old_id in self.placeholders:
-                cell: types.CellType = self.placeholders[old_id]
+            if old_id in self.local.placeholders:
+                cell: types.CellType = self.local.placeholders[old_id]
                 cell.cell_contents = cls
+            self.rebuilt[digest] = cls
+            self.digests[cls] = digest
             return cls
+        elif typ == ObjType.CACHED:
+            digest = ser[1]
+            obj = self.rebuilt.get(digest)
+            if obj is None:
+                # one of ours, sent back by the peer
+                obj = self.originals.get(digest)
+            if obj is None:
+                logger.debug(f"deserialize: cache miss {digest.hex()}")
+                obj = self.deserialize(self.rpc.get_cached_endpoint(digest))
+            return obj
         elif typ == ObjType.CELL_REF:
             cell = types.CellType(object())
-            self.placeholders[ser[1]] = cell
+            self.local.placeholders[ser[1]] = cell
             return cell
+        elif typ == ObjType.CONTAINER:
+            kind, items = ser[1:]
+            if kind == "dict":
+                return {self.deserialize(k): self.deserialize(v) for k, v in items}
+            return CONTAINER_TYPES[kind](self.deserialize(v) for v in items)
+        elif typ == ObjType.BUFFER:
+            return deserialize_buffer(*ser[1:])
+        elif typ == ObjType.PICKLED:
+            return pickle.loads(ser[1])
+        elif typ == ObjType.DATACLASS:
+            cls_ser, fields = ser[1:]
+            cls = self.deserialize(cls_ser)
+            obj = cls.__new__(cls)
+            for name, value in fields.items():
+                # works for frozen and slotted dataclasses too
+                object.__setattr__(obj, name, self.deserialize(value))
+            return obj
         elif typ == ObjType.CELL_DIRECT:
             return types.CellType(self.deserialize(ser[1]))
         elif typ == ObjType.REF:
-            obj_id = ser[1]
-            return NetworkObj(self, obj_id)
+            obj_id, cls_id = ser[1:]
+            return self.netobj(self, obj_id, cls_id)
+        elif typ == ObjType.BACKREF:
+            obj = ser[1]
+            if isinstance(obj, msgpack.ExtType):
+                obj = self.resolve_backref(obj.data)
+            if type(obj) is MissingRef:
+                raise KeyError(f"object {obj.obj_id} was released or expired")
+            return obj
+        elif typ == ObjType.PROMISE:
+            obj = self.deserialize([ObjType.BACKREF.value, ser[1]])
+            return self.evaluate(obj, ser[2])
         elif typ == ObjType.MOD_IMPORT:
             mod, attr = ser[1:]
             if attr is None:
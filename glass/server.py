@@ -1,53 +1,333 @@
 import os
+import sys
+import signal
 import socket
 import logging
+import argparse
+import importlib
+import selectors
 from .serdes import Serializer
 from .bidirpc import BidirPC
+from .local import listen_local, socket_path
+from .memo import MemoCache, SharedCache, cache_path, listen_cache, serve_cache
+from .session import SESSION_TTL, Session, answer, hand_off, read_hello, session_paths
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="[%(levelname)s][%(process)d] %(asctime)s %(name)s: %(message)s",
-)
 logger = logging.getLogger(__name__)
 
 
-if __name__ == "__main__":
-    import sys
+def serve_connection(conn, addr, port=None, session_ttl=SESSION_TTL, **options):
+    logger.info(f"connection accepted from {addr or 'unix socket'}")
+    HOME = os.environ["HOME"]
+    logger.info(f"setting workdir to {HOME}")
+    os.chdir(HOME)
+    session = None
+    token = read_hello(conn)
+    if token is not None:
+        if any(token) and hand_off(port, token, conn):
+            logger.info("handed over to its session")
+            conn.close()
+            return
+        session = Session(port, session_ttl)
+        answer(conn, session.token, False)
+        logger.info("new session")
 
-    if len(sys.argv) != 3:
-        print("Usage: server.py <host> <port>")
-        sys.exit(1)
+    rpc = BidirPC()
+    rpc.connect(conn)
+    ser = Serializer(rpc, **options)
+    while True:
+        if session is not None:
+            session.current = conn
+        rpc.serve()
+        logger.info(f"connection closed, references: {ser.ref_stats()}")
+        if rpc.metrics is not None:
+            logger.info(f"connection metrics: {rpc.metrics.snapshot()}")
+        conn.close()
+        if session is None:
+            return
+        conn = session.next()
+        if conn is None:
+            logger.info(f"session expired after {session_ttl}s")
+            return
+        # same functions, globals and references, on the client's new connection
+        logger.info("session resumed")
+        answer(conn, session.token, True)
+        rpc = BidirPC()
+        rpc.connect(conn)
+        ser.attach(rpc)
 
-    host = sys.argv[1]
-    port = int(sys.argv[2])
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((host, port))
-    s.listen(5)
+class Server:
+    """
+    Accepts connections on TCP and on the same-host Unix socket, serving each
+    one in a process of its own. Either a child forked per connection, or, with
+    `workers`, a fixed pool of pre-forked workers serving one connection at a
+    time and recycled after `max_requests` connections.
 
-    while True:
-        conn, addr = s.accept()
+    `preload` modules are imported before any fork, so every connection starts
+    with them warm and their memory is shared copy-on-write. Connections past
+    `max_children` busy processes wait in the listen queue, at most `backlog`
+    deep, after which new ones are refused.
+
+    `max_refs` and `ref_ttl` bound each connection's reference table, see
+    `Serializer`.
+
+    Results of functions captured with `cache` are kept by a separate cache
+    process, holding up to `memo_entries` results and `memo_bytes` bytes, so
+    they outlive the connection that computed them.
+
+    A client that asks for a session keeps its process after the connection
+    drops, for `session_ttl` seconds, and gets it back when it reconnects with
+    the session's token, see `glass.session`. Until then the process counts
+    towards `max_children`, or holds on to its worker with `workers`.
+    """
+
+    def __init__(
+        self,
+        host,
+        port,
+        workers=0,
+        preload=(),
+        max_requests=0,
+        max_children=0,
+        backlog=64,
+        max_refs=None,
+        ref_ttl=None,
+        memo_entries=4096,
+        memo_bytes=256 << 20,
+        session_ttl=SESSION_TTL,
+    ):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.preload = preload
+        self.max_requests = max_requests
+        self.max_children = max_children
+        self.backlog = backlog
+        self.memo_entries = memo_entries
+        self.memo_bytes = memo_bytes
+        self.options = {
+            "port": port,
+            "session_ttl": session_ttl,
+            "max_refs": max_refs,
+            "ref_ttl": ref_ttl,
+            "memo": SharedCache(cache_path(port)),
+        }
+        self.children = set()
+        self.listeners = []
+        self.memo_pid = None
+
+    def listen(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((self.host, self.port))
+        s.listen(self.backlog)
+        # same-host clients connect here instead, see glass.local
+        u = listen_local(self.port, self.backlog)
+        self.listeners = [s, u]
+        logger.info(f"listening on {self.host}:{self.port} and {socket_path(self.port)}")
+
+    def start_memo(self):
+        listener = listen_cache(self.port)
+        cache = MemoCache(self.memo_entries, self.memo_bytes)
+        self.memo_pid = self.fork(self.run_memo, listener, cache)
+        listener.close()
+        logger.info(f"memo cache {self.memo_pid} on {cache_path(self.port)}")
+
+    def run_memo(self, listener, cache):
+        for sock in self.listeners:
+            sock.close()
+        serve_cache(listener, cache)
+
+    def warm_up(self):
+        for name in self.preload:
+            importlib.import_module(name)
+            logger.info(f"preloaded {name}")
+
+    def run(self):
+        self.listen()
+        self.start_memo()
+        self.warm_up()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            if self.workers:
+                self.run_pool()
+            else:
+                self.run_forking()
+        finally:
+            self.shutdown()
+
+    def stop(self, signum, frame):
+        # unwinds out of select() and waitpid(), which retry on signals otherwise
+        raise SystemExit(0)
+
+    def shutdown(self):
+        for pid in [*self.children, self.memo_pid]:
+            if pid is None:
+                continue
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for listener in self.listeners:
+            listener.close()
+        for path in [socket_path(self.port), cache_path(self.port), *session_paths(self.port)]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def reap(self, block):
+        """
+        Collect exited children, returns how many there were.
+        """
+        count = 0
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0 if block and not count else os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.children:
+                self.children.remove(pid)
+                logger.debug(f"worker {pid} exited with status {os.waitstatus_to_exitcode(status)}")
+            elif pid == self.memo_pid:
+                # connections fall back to caches of their own
+                logger.error(f"memo cache exited with status {os.waitstatus_to_exitcode(status)}")
+                self.memo_pid = None
+            count += 1
+        return count
+
+    def fork(self, target, *args):
         pid = os.fork()
         if pid == 0:
-            pid = os.getpid()
-            logger.info(f"connection accepted from {addr}")
-            HOME = os.environ["HOME"]
-            logger.info(f"setting workdir to {HOME}")
-            os.chdir(HOME)
-            rpc = BidirPC()
-            rpc.connect(conn)
-            ser = Serializer(rpc)
-            while True:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                target(*args)
+            except BaseException:
+                logger.exception("child failed")
+                code = 1
+            finally:
+                os._exit(code)
+        return pid
+
+    def run_forking(self):
+        sel = selectors.DefaultSelector()
+        for listener in self.listeners:
+            sel.register(listener, selectors.EVENT_READ)
+
+        while True:
+            self.reap(block=False)
+            if self.max_children and len(self.children) >= self.max_children:
+                # admission control, the rest wait in the listen queue
+                self.reap(block=True)
+                continue
+            # wakes up now and then to reap children
+            for key, _ in sel.select(timeout=1.0):
+                conn, addr = key.fileobj.accept()
+                pid = self.fork(self.child, sel, conn, addr)
+                self.children.add(pid)
+                conn.close()
+
+    def child(self, sel, conn, addr):
+        sel.close()
+        for listener in self.listeners:
+            listener.close()
+        serve_connection(conn, addr, **self.options)
+
+    def run_pool(self):
+        for listener in self.listeners:
+            # workers race for each connection, the losers go back to waiting
+            listener.setblocking(False)
+
+        while True:
+            while len(self.children) < self.workers:
+                pid = self.fork(self.worker)
+                self.children.add(pid)
+                logger.info(f"started worker {pid}")
+            self.reap(block=True)
+
+    def worker(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        sel = selectors.DefaultSelector()
+        for listener in self.listeners:
+            sel.register(listener, selectors.EVENT_READ)
+
+        served = 0
+        while not self.max_requests or served < self.max_requests:
+            for key, _ in sel.select():
                 try:
-                    rpc.recv()
-                except EOFError:
-                    logger.info("connection closed")
-                    break
-                except Exception as e:
-                    rpc.exception(e)
+                    conn, addr = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                serve_connection(conn, addr, **self.options)
+                served += 1
+                break
+        logger.info(f"recycling after {served} connections")
 
-            conn.close()
-            os._exit(0)
-        else:
-            conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m glass.server")
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument(
+        "--workers", type=int, default=0, help="pre-forked worker pool size, 0 forks per connection"
+    )
+    parser.add_argument(
+        "--preload", action="append", default=[], help="module to import before forking, repeatable"
+    )
+    parser.add_argument(
+        "--max-requests", type=int, default=0, help="connections served before a worker is recycled"
+    )
+    parser.add_argument(
+        "--max-children", type=int, default=0, help="concurrent connections without --workers"
+    )
+    parser.add_argument("--backlog", type=int, default=64, help="listen queue length")
+    parser.add_argument(
+        "--max-refs", type=int, help="objects a connection may hold by reference, LRU evicted"
+    )
+    parser.add_argument(
+        "--ref-ttl", type=float, help="seconds an unused reference is kept for its client"
+    )
+    parser.add_argument(
+        "--memo-entries", type=int, default=4096, help="results kept for capture(cache=...)"
+    )
+    parser.add_argument(
+        "--memo-mb", type=float, default=256, help="memory for capture(cache=...) results"
+    )
+    parser.add_argument(
+        "--session-ttl",
+        type=float,
+        default=SESSION_TTL,
+        help="seconds a session waits for its client to reconnect",
+    )
+    parser.add_argument("--log-level", default="INFO")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format="[%(levelname)s][%(process)d] %(asctime)s %(name)s: %(message)s",
+    )
+    preload = [name for arg in args.preload for name in arg.split(",") if name]
+    Server(
+        args.host,
+        args.port,
+        workers=args.workers,
+        preload=preload,
+        max_requests=args.max_requests,
+        max_children=args.max_children,
+        backlog=args.backlog,
+        max_refs=args.max_refs,
+        ref_ttl=args.ref_ttl,
+        memo_entries=args.memo_entries,
+        memo_bytes=int(args.memo_mb * (1 << 20)),
+        session_ttl=args.session_ttl,
+    ).run()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,180 @@
+"""
+Server sessions that outlive their connection, see `Remote(session=...)`.
+
+A client that wants one opens its connection with a HELLO: a byte no msgpack
+frame starts with, then a session token, all zeros for a new session. The
+process serving a session listens on a Unix socket of its own, named after a
+digest of the token. A later connection presenting the token is handed over to
+that process, descriptor and all, so the client finds its functions, globals
+and remote objects as it left them. A session nobody comes back to within its
+TTL ends with its process.
+"""
+
+import os
+import glob
+import hmac
+import queue
+import socket
+import hashlib
+import logging
+import secrets
+import tempfile
+import threading
+from . import local
+
+logger = logging.getLogger(__name__)
+
+# never used by msgpack, so it can't be the start of a frame
+HELLO = b"\xc1"
+TOKEN_SIZE = 16
+# seconds a session waits for its client to come back
+SESSION_TTL = 300.0
+
+
+def session_path(port, token):
+    name = hashlib.blake2b(token, digest_size=8).hexdigest()
+    return os.path.join(tempfile.gettempdir(), f"glass-{port}-{name}.session.sock")
+
+
+def session_paths(port):
+    return glob.glob(os.path.join(tempfile.gettempdir(), f"glass-{port}-*.session.sock"))
+
+
+def recv_exactly(conn, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    pos = 0
+    while pos < n:
+        got = conn.recv_into(view[pos:])
+        if not got:
+            raise EOFError("connection closed during the session handshake")
+        pos += got
+    return bytes(buf)
+
+
+def hello(conn, token=None):
+    """
+    Ask for session `token`, or a new one, before anything else is sent on
+    `conn`. Returns the session's token and whether it was resumed.
+    """
+    conn.sendall(HELLO + (token or bytes(TOKEN_SIZE)))
+    reply = recv_exactly(conn, TOKEN_SIZE + 2)
+    return reply[1:-1], reply[-1] == 1
+
+
+def read_hello(conn):
+    """
+    The token a new connection asks for, zeros for a new session, or None if
+    it didn't open with a HELLO.
+    """
+    if conn.recv(1, socket.MSG_PEEK) != HELLO:
+        return None
+    return recv_exactly(conn, TOKEN_SIZE + 1)[1:]
+
+
+def answer(conn, token, resumed):
+    conn.sendall(HELLO + token + bytes([resumed]))
+
+
+def hand_off(port, token, conn):
+    """
+    Pass `conn` to the process serving session `token`, True if it took it.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(session_path(port, token))
+        s.sendmsg([token], local.fds_message([conn.fileno()]))
+        return s.recv(1) == b"\x01"
+    except OSError as e:
+        logger.debug(f"session not found ({e})")
+        return False
+    finally:
+        s.close()
+
+
+class Session:
+    """
+    The serving end of a new session: its token, and the socket connections
+    that present it are handed over through. `next()` waits for one.
+    """
+
+    def __init__(self, port, ttl=SESSION_TTL):
+        self.token = secrets.token_bytes(TOKEN_SIZE)
+        self.ttl = ttl
+        self.path = session_path(port, self.token)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.listener.listen(4)
+        self.conns = queue.Queue()
+        # the connection being served, dropped when the client comes back on another
+        self.current = None
+        self.expired = False
+        self.lock = threading.Lock()
+        threading.Thread(target=self.accept, name="glass-session", daemon=True).start()
+
+    def accept(self):
+        while True:
+            try:
+                s, _ = self.listener.accept()
+            except OSError:
+                return
+            with s:
+                try:
+                    conn = self.take(s)
+                except (OSError, EOFError) as e:
+                    logger.debug(f"session hand-off failed: {e}")
+                    continue
+                if conn is None:
+                    continue
+                with self.lock:
+                    if self.expired:
+                        conn.close()
+                        continue
+                    s.sendall(b"\x01")
+                    self.conns.put(conn)
+                    if self.current is not None:
+                        # unblocks the reader, the client has moved on
+                        try:
+                            self.current.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+
+    def take(self, s):
+        """
+        The connection passed over `s`, if it came with our token.
+        """
+        buf = bytearray(TOKEN_SIZE)
+        n, fds = local.recv_fds_into(s, memoryview(buf))
+        conns = [socket.socket(fileno=fd) for fd in fds]
+        if n < TOKEN_SIZE:
+            buf[n:] = recv_exactly(s, TOKEN_SIZE - n)
+        if len(conns) != 1 or not hmac.compare_digest(bytes(buf), self.token):
+            logger.warning("rejected a session hand-off with a wrong token")
+            for conn in conns:
+                conn.close()
+            return None
+        return conns[0]
+
+    def next(self):
+        """
+        The client's next connection, or None once it didn't come back within
+        the TTL, which ends the session.
+        """
+        try:
+            return self.conns.get(timeout=self.ttl)
+        except queue.Empty:
+            pass
+        with self.lock:
+            if not self.conns.empty():
+                return self.conns.get_nowait()
+            self.expired = True
+        self.close()
+        return None
+
+    def close(self):
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
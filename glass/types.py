@@ -4,8 +4,41 @@ class ObjType(Enum):
     SIMPLE = 0
     FUNC = 1
     CLS = 2
+    CACHED = 3
     CELL_REF = 5
     CELL_DIRECT = 6
+    CONTAINER = 7
+    DATACLASS = 8
+    PICKLED = 9
     REF = 10
     MOD_IMPORT = 11
+    # a REF the receiver handed out, sent back to it
+    BACKREF = 12
+    BUFFER = 13
+    # a chain of operations on one of the receiver's objects, evaluated there
+    PROMISE = 14
 
+
+class ExtCode(Enum):
+    # msgpack-native value packed ahead of the frame, decoded in place on receipt
+    PACKED = 1
+    # a stub sent back to its owner, resolved by the reader in frame order
+    BACKREF = 2
+    # index of a raw buffer sent next to the frame
+    BUFFER = 3
+    # a whole frame, compressed, see glass.compress
+    COMPRESSED = 4
+
+
+class AttrKind(Enum):
+    # how a stub may cache an attribute it looked up
+    VALUE = 0
+    METHOD = 1
+    CONSTANT = 2
+
+
+class OpType(Enum):
+    # steps of a pipelined `Promise`
+    GETATTR = 0
+    CALL = 1
+    GETITEM = 2
@@ -1,9 +1,14 @@
 import json
+import msgpack
+import threading
+from collections import OrderedDict
 
 class BytesEncoder(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, bytes):
             return f"<bytes {len(o)}>"
+        elif isinstance(o, msgpack.ExtType):
+            return f"<ext {o.code} {len(o.data)}>"
         else:
             return super().default(o)
 
@@ -15,3 +20,39 @@ def fmt_args_kwargs(args, kwargs):
     args = [f"{pretty(arg)}" for arg in args]
     kwargs = [f"{k}={pretty(v)}" for k, v in kwargs.items()]
     return ", ".join(args + kwargs)
+
+
+class LRUCache:
+    """
+    Thread-safe dict with least-recently-used eviction past `maxsize` entries.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                self.data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.data.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)